@@ -20,14 +20,77 @@ Implementation of pytest-ansible-playbook plugin.
 
 from __future__ import print_function
 import os
-import uuid
+import sys
+import types
 import contextlib
-from playbook_runner import playbook_runner
-import subprocess
-import json
 import pytest
 
 
+# names provided by pytest_ansible_playbook_runner module, which is imported
+# on first use only, so that the plugin doesn't slow down pytest sessions
+# which don't use it
+RUNNER_NAMES = frozenset([
+    'PytestAnsiblePlaybook',
+    'PlaybookResult',
+    'Inventory',
+    'PrefetchScheduler',
+    'ExtraVarsStore',
+    'RunLog',
+    'LeaseManager',
+    'RusagePopen',
+    'TraceRecorder',
+    'LogSpool',
+    'CassetteStore',
+    'DurationHistory',
+    'ExecutionProfile',
+    'GalaxyRequirements',
+    'ConcurrencyLimit',
+    'get_empty_marker_error',
+    'get_missing_file_error',
+    'get_result_statuses',
+    'get_rusage',
+    'get_run_log',
+    'get_extra_vars_store',
+    'get_lease_manager',
+    'get_log_spool',
+    'get_cassettes',
+    'get_deferred_failures',
+])
+
+
+def get_runner():
+    """
+    Import and return module with the playbook runner machinery.
+    """
+    import pytest_ansible_playbook_runner
+    return pytest_ansible_playbook_runner
+
+
+class LazyRunnerModule(types.ModuleType):
+    """
+    Module type providing names of the playbook runner machinery on first
+    access. Unlike module level ``__getattr__`` (PEP 562, python 3.7+),
+    assigning the class of a module works since python 3.5.
+    """
+
+    def __getattr__(self, name):
+        if name in RUNNER_NAMES:
+            return getattr(get_runner(), name)
+        raise AttributeError(
+            "module {0!r} has no attribute {1!r}".format(self.__name__, name))
+
+
+sys.modules[__name__].__class__ = LazyRunnerModule
+
+
+def pytest_addhooks(pluginmanager):
+    """
+    Register hook specifications of this plugin.
+    """
+    import pytest_ansible_playbook_hooks
+    pluginmanager.add_hookspecs(pytest_ansible_playbook_hooks)
+
+
 def pytest_addoption(parser):
     """
     Define py.test command line options for this plugin.
@@ -47,9 +110,140 @@ def pytest_addoption(parser):
         metavar="INVENTORY_FILE",
         help='Ansible inventory file.',
         )
+    group.addoption(
+        '--ansible-playbook-matrix-inventory',
+        action='append',
+        dest='ansible_playbook_matrix_inventory',
+        metavar="INVENTORY_FILE",
+        help='Ansible inventory file to be used instead of '
+             '--ansible-playbook-inventory, when used more times, test cases '
+             'are parametrized by the inventories.',
+        )
+    group.addoption(
+        '--ansible-playbook-inventory-lanes',
+        action='store_true',
+        dest='ansible_playbook_inventory_lanes',
+        help='Run test cases of each inventory in a single pytest-xdist '
+             'worker, so that inventories are tested concurrently '
+             '(requires -n N --dist loadgroup).',
+        )
+    group.addoption(
+        '--ansible-playbook-trace',
+        action='store',
+        dest='ansible_playbook_trace',
+        metavar="TRACE_FILE",
+        help='Write timeline of tests, playbooks and ansible tasks into '
+             'given file, in Chrome trace event format.',
+        )
+    group.addoption(
+        '--ansible-playbook-rusage',
+        action='store',
+        type=int,
+        dest='ansible_playbook_rusage',
+        metavar="N",
+        help='Show N ansible-playbook runs with the highest CPU usage '
+             '(N=0 for all).',
+        )
+    group.addoption(
+        '--ansible-playbook-max-concurrent',
+        action='store',
+        type=int,
+        dest='ansible_playbook_max_concurrent',
+        metavar="N",
+        help='Run at most N ansible-playbook processes at once, across all '
+             'pytest sessions and pytest-xdist workers on this machine.',
+        )
+    group.addoption(
+        '--ansible-playbook-prefetch',
+        action='store_true',
+        dest='ansible_playbook_prefetch',
+        help='Run setup playbooks of the next test case in background, when '
+             'their declared hosts don\'t overlap with hosts of the '
+             'current test case.',
+        )
+    group.addoption(
+        '--ansible-playbook-spool',
+        action='store',
+        dest='ansible_playbook_spool',
+        metavar="SPOOL_DIR",
+        help='Stream output of ansible-playbook runs into compressed per '
+             'test log files in given directory, keeping logs of failed '
+             'tests only.',
+        )
+    group.addoption(
+        '--ansible-playbook-spool-tail',
+        action='store',
+        type=int,
+        default=16,
+        dest='ansible_playbook_spool_tail',
+        metavar="KB",
+        help='Size of the output tail attached to reports of failed tests, '
+             'when --ansible-playbook-spool is used (default: 16).',
+        )
+    group.addoption(
+        '--ansible-playbook-record',
+        action='store',
+        dest='ansible_playbook_record',
+        metavar="CASSETTE_DIR",
+        help='Record return code and output of every playbook run into '
+             'cassette files in given directory.',
+        )
+    group.addoption(
+        '--ansible-playbook-replay',
+        action='store',
+        dest='ansible_playbook_replay',
+        metavar="CASSETTE_DIR",
+        help='Return recorded playbook runs from cassette files in given '
+             'directory instead of running ansible-playbook.',
+        )
+    group.addoption(
+        '--ansible-playbook-replay-strict',
+        action='store_true',
+        dest='ansible_playbook_replay_strict',
+        help='Fail playbook runs which are not recorded in cassettes given '
+             'by --ansible-playbook-replay, instead of running them.',
+        )
+    group.addoption(
+        '--ansible-playbook-profile',
+        action='store',
+        choices=['fast'],
+        dest='ansible_playbook_profile',
+        metavar="PROFILE",
+        help='Tune forks, strategy, fact gathering and pipelining of '
+             'ansible-playbook runs, unless configured explicitly in '
+             'ansible.cfg (choices: fast).',
+        )
+    group.addoption(
+        '--ansible-playbook-requirements',
+        action='store',
+        dest='ansible_playbook_requirements',
+        metavar="REQUIREMENTS_FILE",
+        help='Install roles and collections of given ansible-galaxy '
+             'requirements file into pytest cache, unless installed already, '
+             'and use them in all ansible runs.',
+        )
+    group.addoption(
+        '--ansible-playbook-history',
+        action='store',
+        type=int,
+        dest='ansible_playbook_history',
+        metavar="N",
+        help='Keep wall time of playbook runs of the last N sessions in '
+             'pytest cache and report playbooks slower than their history.',
+        )
+    group.addoption(
+        '--ansible-playbook-slowdown-threshold',
+        action='store',
+        type=float,
+        dest='ansible_playbook_slowdown_threshold',
+        metavar="RATIO",
+        help='Fail the session when a playbook reported by '
+             '--ansible-playbook-history is RATIO times slower than the '
+             'median of its history.',
+        )
 
 
-def pytest_configure(config):
+def check_options(config):
     """
     Validate pytest-ansible-playbook options: when such option is used,
     the given file or directory should exist.
@@ -64,151 +258,308 @@ def pytest_configure(config):
             "value of --ansible-playbook-directory option ({0}) "
             "is not a directory").format(dir_path)
         raise pytest.UsageError(msg)
-    inventory_path = config.getvalue('ansible_playbook_inventory')
-    if inventory_path is None:
-        return
-    if not os.path.isabs(inventory_path) and dir_path is not None:
-        inventory_path = os.path.join(dir_path, inventory_path)
-    if not os.path.isfile(inventory_path):
+    replay_path = config.getvalue('ansible_playbook_replay')
+    if replay_path is not None and not os.path.isdir(replay_path):
         msg = (
-            "value of --ansible-playbook-inventory option ({}) "
-            "is not accessible").format(inventory_path)
+            "value of --ansible-playbook-replay option ({0}) "
+            "is not a directory").format(replay_path)
         raise pytest.UsageError(msg)
+    max_concurrent = config.getvalue('ansible_playbook_max_concurrent')
+    if max_concurrent is not None and max_concurrent < 1:
+        msg = (
+            "value of --ansible-playbook-max-concurrent option ({0}) "
+            "is lower than 1").format(max_concurrent)
+        raise pytest.UsageError(msg)
+    history = config.getvalue('ansible_playbook_history')
+    if history is not None and history < 3:
+        msg = (
+            "value of --ansible-playbook-history option ({0}) "
+            "is lower than 3").format(history)
+        raise pytest.UsageError(msg)
+    if history is not None and \
+            not config.pluginmanager.hasplugin('cacheprovider'):
+        msg = "--ansible-playbook-history option requires cacheprovider plugin"
+        raise pytest.UsageError(msg)
+    requirements_path = get_requirements_path(config)
+    if requirements_path is not None:
+        if not os.path.isfile(requirements_path):
+            msg = (
+                "value of --ansible-playbook-requirements option ({0}) "
+                "is not accessible").format(requirements_path)
+            raise pytest.UsageError(msg)
+        if not config.pluginmanager.hasplugin('cacheprovider'):
+            msg = (
+                "--ansible-playbook-requirements option requires "
+                "cacheprovider plugin")
+            raise pytest.UsageError(msg)
+    if config.getvalue('ansible_playbook_inventory_lanes') and \
+            getattr(config.option, 'dist', None) != 'loadgroup':
+        msg = (
+            "--ansible-playbook-inventory-lanes option requires pytest-xdist "
+            "plugin with --dist loadgroup")
+        raise pytest.UsageError(msg)
+    if config.getvalue('ansible_playbook_inventory') is not None and \
+            config.getvalue('ansible_playbook_matrix_inventory'):
+        msg = (
+            "--ansible-playbook-matrix-inventory option can't be used "
+            "together with --ansible-playbook-inventory option")
+        raise pytest.UsageError(msg)
+    option = '--ansible-playbook-inventory'
+    if config.getvalue('ansible_playbook_matrix_inventory'):
+        option = '--ansible-playbook-matrix-inventory'
+    for inventory_path in get_inventory_options(config):
+        if not os.path.isabs(inventory_path) and dir_path is not None:
+            inventory_path = os.path.join(dir_path, inventory_path)
+        if not os.path.isfile(inventory_path):
+            msg = (
+                "value of {} option ({}) "
+                "is not accessible").format(option, inventory_path)
+            raise pytest.UsageError(msg)
 
 
-def get_empty_marker_error(marker_type):
+def pytest_configure(config):
+    """
+    Validate pytest-ansible-playbook options and set up optional features
+    of this plugin.
     """
-    Generate error message for empty marker.
+    check_options(config)
+
+    trace_path = config.getvalue('ansible_playbook_trace')
+    if trace_path is not None:
+        tracer = get_runner().TraceRecorder(
+            trace_path, get_worker_id(config))
+        config._ansible_playbook_trace = tracer
+        config.pluginmanager.register(tracer, 'ansible_playbook_trace')
+
+    max_concurrent = config.getvalue('ansible_playbook_max_concurrent')
+    if max_concurrent is not None:
+        config._ansible_playbook_concurrency = get_runner().ConcurrencyLimit(
+            max_concurrent)
+
+    if config.getvalue('ansible_playbook_prefetch'):
+        scheduler = get_runner().PrefetchScheduler()
+        config._ansible_playbook_prefetch = scheduler
+        config.pluginmanager.register(scheduler, 'ansible_playbook_prefetch')
+
+    spool_path = config.getvalue('ansible_playbook_spool')
+    if spool_path is not None:
+        spool = get_runner().LogSpool(
+            spool_path, config.getvalue('ansible_playbook_spool_tail') * 1024)
+        config._ansible_playbook_spool = spool
+        config.pluginmanager.register(spool, 'ansible_playbook_spool')
+
+    profile = config.getvalue('ansible_playbook_profile')
+    if profile is not None:
+        config._ansible_playbook_profile = get_runner().ExecutionProfile(
+            profile)
+
+    requirements_path = get_requirements_path(config)
+    if requirements_path is not None:
+        galaxy = get_runner().GalaxyRequirements(
+            requirements_path,
+            str(config.cache.makedir('ansible_playbook_galaxy')),
+            config.getvalue('ansible_playbook_directory') or os.getcwd())
+        galaxy.install()
+        config._ansible_playbook_galaxy = galaxy
+
+    record_path = config.getvalue('ansible_playbook_record')
+    replay_path = config.getvalue('ansible_playbook_replay')
+    if record_path is not None or replay_path is not None:
+        config._ansible_playbook_cassettes = get_runner().CassetteStore(
+            record_path,
+            replay_path,
+            config.getvalue('ansible_playbook_replay_strict'))
+
+
+def get_inventory_options(config):
     """
-    msg = (
-        "no playbook is specified in "
-        "``@pytest.mark.ansible_playbook_{0}`` decorator "
-        "of this test case, please add at least one playbook "
-        "file name as a parameter into the marker, eg. "
-        "``@pytest.mark.ansible_playbook_{0}('playbook.yml')``")
-    return msg.format(marker_type)
+    Return list of inventories given by ``--ansible-playbook-matrix-inventory``
+    options, or by ``--ansible-playbook-inventory`` option.
+    """
+    inventories = config.getvalue('ansible_playbook_matrix_inventory')
+    if inventories:
+        return inventories
+    inventory = config.getvalue('ansible_playbook_inventory')
+    return [inventory] if inventory is not None else []
 
 
-def get_missing_file_error(marker_type, playbook):
+def get_inventory_ids(inventories):
+    """
+    Return test ids of given inventories, as used in parametrized tests.
     """
-        Generate error message for empty marker.
-        """
-    msg = (
-        "no file is specified in "
-        "``@pytest.mark.ansible_playbook_{0}`` decorator "
-        "for the playbook - ``{1}``")
-    return msg.format(marker_type, playbook)
+    ids = [
+        os.path.splitext(os.path.basename(path))[0] for path in inventories]
+    if len(set(ids)) < len(ids):
+        ids = [
+            '{0}{1}'.format(name, index) for index, name in enumerate(ids)]
+    return ids
 
 
-class PytestAnsiblePlaybook(playbook_runner.AnsiblePlaybook):
-    def __init__(self, ansible_playbook_inventory, ansible_playbook_directory,
-                 request, session_uuid=None):
-        playbook_runner.AnsiblePlaybook.__init__(
-            self,
-            ansible_playbook_inventory,
-            ansible_playbook_directory,
-        )
+def pytest_generate_tests(metafunc):
+    """
+    Parametrize test cases using inventory by each inventory given by
+    ``--ansible-playbook-matrix-inventory`` options, when the option is used
+    more times.
+    """
+    inventories = get_inventory_options(metafunc.config)
+    if len(inventories) < 2:
+        return
+    if 'ansible_playbook_inventory_option' not in metafunc.fixturenames:
+        return
+    metafunc.parametrize(
+        'ansible_playbook_inventory_option',
+        inventories,
+        indirect=True,
+        scope='session',
+        ids=get_inventory_ids(inventories))
 
-        self._request = request
-        self._setup_playbooks = []
-        self._teardown_playbooks = []
-
-        self.session_uuid = session_uuid
-        self.outputs = {
-            'setup': {},
-            'teardown': {},
-        }
-        self._inventory = None
-
-    def get_inventory(self):
-        if self._inventory is not None:
-            return self._inventory
-
-        cmd = [
-                'ansible-inventory',
-                '-i',
-                self._ansible_playbook_inventory,
-                '--list'
-                ]
-        proc = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        proc.wait(timeout=60)
-        stdout, stderr = proc.communicate(timeout=10)
-        self._inventory = json.loads(stdout.decode('utf-8'))
-        return self._inventory
-
-    def add_to_teardown(self, element):
-        self._teardown_playbooks.append(element)
-
-    def fill_from_custom(self, setup, teardown):
-        self._setup_playbooks = setup
-        self._teardown_playbooks = teardown
-
-    def fill_from_markers(self):
-        if hasattr(self._request.node, "iter_markers"):
-            # since pytest 4.0.0, markers api changed, see:
-            # https://github.com/pytest-dev/pytest/pull/4564
-            # https://docs.pytest.org/en/latest/mark.html#updating-code
-            setup_ms = self._request.node.iter_markers(
-                'ansible_playbook_setup')
-            teardown_ms = self._request.node.iter_markers(
-                'ansible_playbook_teardown')
-        else:
-            marker = self._request.node.get_marker('ansible_playbook_setup')
-            setup_ms = [marker] if marker is not None else []
-            marker = self._request.node.get_marker('ansible_playbook_teardown')
-            teardown_ms = [marker] if marker is not None else []
-
-        for marker in setup_ms:
-            if len(marker.args) == 0:
-                raise Exception(get_empty_marker_error("setup"))
-            # extend because multiple mark entries are supported
-            self._setup_playbooks.extend(marker.args)
-        for marker in teardown_ms:
-            if len(marker.args) == 0:
-                raise Exception(get_empty_marker_error("teardown"))
-            # extend because multiple mark entries are supported
-            self._teardown_playbooks.extend(list(marker.args))
-
-    def run_playbook(self, play_filename, extra_vars_dict=None):
-        if extra_vars_dict is None:
-            extra_vars_dict = {}
-        ret = playbook_runner.AnsiblePlaybook.run_playbook(self, play_filename, extra_vars_dict)
-        if 'skip_errors' not in extra_vars_dict or \
-                not extra_vars_dict['skip_errors']:
-            assert ret == 0
-
-        return self.get_output()
-
-    def setup(self):
-        for playbook in self._setup_playbooks:
-            if 'file' not in playbook:
-                raise Exception(get_missing_file_error("setup", playbook))
-
-            extra_vars = {"session_uuid": self.session_uuid}
-            if 'extra_vars' in playbook:
-                for k, v in playbook['extra_vars'].items():
-                    extra_vars[k] = v
-
-            self.outputs['setup'][playbook['file']] = \
-                self.run_playbook(playbook['file'], extra_vars)
-
-    def teardown(self):
-        for playbook in self._teardown_playbooks:
-            if 'file' not in playbook:
-                raise Exception(get_missing_file_error("teardown", playbook))
-
-            extra_vars = {"session_uuid": self.session_uuid}
-            if 'extra_vars' in playbook:
-                for k, v in playbook['extra_vars'].items():
-                    extra_vars[k] = v
-
-            self.outputs['teardown'][playbook['file']] = \
-                self.run_playbook(playbook['file'], extra_vars)
+
+# before pytest-xdist reads the groups
+@pytest.hookimpl(tryfirst=True)
+def pytest_collection_modifyitems(config, items):
+    """
+    Put test cases of each inventory into a pytest-xdist group, when
+    ``--ansible-playbook-inventory-lanes`` option is used.
+    """
+    inventories = get_inventory_options(config)
+    if not config.getvalue('ansible_playbook_inventory_lanes') or \
+            len(inventories) < 2:
+        return
+    ids = dict(zip(inventories, get_inventory_ids(inventories)))
+    for item in items:
+        callspec = getattr(item, 'callspec', None)
+        if callspec is None or \
+                'ansible_playbook_inventory_option' not in callspec.params:
+            continue
+        inventory = callspec.params['ansible_playbook_inventory_option']
+        item.add_marker(pytest.mark.xdist_group(
+            'ansible_playbook_inventory_{0}'.format(ids[inventory])))
+
+
+def get_requirements_path(config):
+    """
+    Return path of ansible-galaxy requirements file given by
+    ``--ansible-playbook-requirements`` option, which is relative to the
+    playbook directory, or None.
+    """
+    path = config.getvalue('ansible_playbook_requirements')
+    dir_path = config.getvalue('ansible_playbook_directory')
+    if path is not None and not os.path.isabs(path) and dir_path is not None:
+        path = os.path.join(dir_path, path)
+    return path
+
+
+def pytest_sessionfinish(session):
+    """
+    Pass records of playbook runs, host leases and failed deferred
+    teardowns of a pytest-xdist worker to the master, or fail the session
+    on failed deferred teardowns and update duration history of playbooks
+    in the master.
+    """
+    config = session.config
+    workeroutput = getattr(config, 'workeroutput', None)
+    run_log = getattr(config, '_ansible_playbook_runs', None)
+    if workeroutput is not None and run_log is not None:
+        workeroutput['ansible_playbook_runs'] = run_log.records
+    leases = getattr(config, '_ansible_playbook_leases', None)
+    if workeroutput is not None and leases is not None:
+        workeroutput['ansible_playbook_leases'] = leases.records
+    deferred_failures = getattr(
+        config, '_ansible_playbook_deferred_failures', None)
+    if workeroutput is not None and deferred_failures is not None:
+        workeroutput['ansible_playbook_deferred_failures'] = \
+            deferred_failures
+    if workeroutput is None and deferred_failures and \
+            session.exitstatus == 0:
+        session.exitstatus = 1
+
+    history = config.getvalue('ansible_playbook_history')
+    if workeroutput is not None or history is None or run_log is None:
+        return
+    slowdowns = get_runner().DurationHistory(config.cache, history).update(
+        run_log.records)
+    config._ansible_playbook_slowdowns = slowdowns
+    threshold = config.getvalue('ansible_playbook_slowdown_threshold')
+    if threshold is not None and session.exitstatus == 0 and any(
+            s['ratio'] >= threshold for s in slowdowns):
+        session.exitstatus = 1
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    """
+    Merge records of playbook runs, host leases and failed deferred
+    teardowns of a finished pytest-xdist worker.
+    """
+    workeroutput = getattr(node, 'workeroutput', {})
+    records = workeroutput.get('ansible_playbook_runs')
+    if records:
+        get_runner().get_run_log(node.config).records.extend(records)
+    records = workeroutput.get('ansible_playbook_leases')
+    if records:
+        get_runner().get_lease_manager(node.config).records.extend(records)
+    records = workeroutput.get('ansible_playbook_deferred_failures')
+    if records:
+        get_runner().get_deferred_failures(node.config).extend(records)
+
+
+def pytest_terminal_summary(terminalreporter):
+    """
+    Report failed deferred teardowns, ansible-playbook runs with the highest
+    resource usage, time spent waiting for host leases and free slots of
+    ansible-playbook runs, and playbooks slower than their history.
+    """
+    config = terminalreporter.config
+    deferred_failures = getattr(
+        config, '_ansible_playbook_deferred_failures', None)
+    if deferred_failures:
+        get_runner().report_deferred_failures(
+            terminalreporter, deferred_failures)
+    top = config.getvalue('ansible_playbook_rusage')
+    if top is not None:
+        get_runner().get_run_log(config).report_rusage(terminalreporter, top)
+    leases = getattr(config, '_ansible_playbook_leases', None)
+    if leases is not None and leases.records:
+        leases.report_waits(terminalreporter)
+    if config.getvalue('ansible_playbook_max_concurrent') is not None:
+        get_runner().get_run_log(config).report_queue_waits(terminalreporter)
+    slowdowns = getattr(config, '_ansible_playbook_slowdowns', None)
+    if slowdowns:
+        get_runner().DurationHistory.report_slowdowns(
+            terminalreporter,
+            slowdowns,
+            config.getvalue('ansible_playbook_slowdown_threshold'))
+
+
+def pytest_unconfigure(config):
+    """
+    Remove session wide temporary files created by this plugin.
+    """
+    store = getattr(config, '_ansible_playbook_extra_vars', None)
+    if store is not None:
+        store.cleanup()
+    tracer = getattr(config, '_ansible_playbook_trace', None)
+    if tracer is not None:
+        config.pluginmanager.unregister(tracer)
+        tracer.close()
+    scheduler = getattr(config, '_ansible_playbook_prefetch', None)
+    if scheduler is not None:
+        config.pluginmanager.unregister(scheduler)
+        scheduler.close()
+    spool = getattr(config, '_ansible_playbook_spool', None)
+    if spool is not None:
+        config.pluginmanager.unregister(spool)
+        spool.close()
+
+
+def get_worker_id(config):
+    """
+    Return id of pytest-xdist worker running this session, or ``master``.
+    """
+    workerinput = getattr(config, 'workerinput', None)
+    if workerinput is None:
+        return 'master'
+    return workerinput['workerid']
 
 
 @contextlib.contextmanager
@@ -216,7 +567,8 @@ def fixture_runner(
         request,
         setup_playbooks=None,
         teardown_playbooks=None,
-        skip_teardown=False):
+        skip_teardown=False,
+        inventory=None):
     """
     Context manager which will run playbooks specified in it's arguments.
 
@@ -225,6 +577,12 @@ def fixture_runner(
     :param teardown_playbooks: list of setup playbook names (optional)
     :param skip_teardown:
         if True, teardown playbooks are not executed when test case fails
+    :param inventory:
+        inventory file path or ``Inventory`` object, used instead of
+        ``--ansible-playbook-inventory`` option (optional); when
+        ``--ansible-playbook-matrix-inventory`` option is used more times,
+        the requesting fixture has to depend on
+        ``ansible_playbook_inventory_option`` fixture
 
     It's expected to be used to build custom fixtures or to be used
     directly in a test case code.
@@ -234,9 +592,15 @@ def fixture_runner(
 
     # process request object
     directory = request.config.option.ansible_playbook_directory
-    inventory = request.config.option.ansible_playbook_inventory
-
-    pap = PytestAnsiblePlaybook(
+    if inventory is None:
+        inventories = get_inventory_options(request.config)
+        if len(inventories) > 1:
+            inventory = request.getfixturevalue(
+                'ansible_playbook_inventory_option')
+        elif inventories:
+            inventory = inventories[0]
+
+    pap = get_runner().PytestAnsiblePlaybook(
         inventory,
         directory,
         request,
@@ -279,7 +643,20 @@ def runner(pap, skip_teardown=False):
 
 
 @pytest.fixture(scope='session')
-def session_uuid():
+def ansible_playbook_inventory_option(request):
+    """
+    Inventory given by ``--ansible-playbook-inventory`` option, or each one
+    of inventories given by ``--ansible-playbook-matrix-inventory`` options.
+    """
+    if hasattr(request, 'param'):
+        return request.param
+    inventories = get_inventory_options(request.config)
+    return inventories[0] if inventories else None
+
+
+@pytest.fixture(scope='session')
+def session_uuid(ansible_playbook_inventory_option):
+    import uuid
     return uuid.uuid4()
 
 
@@ -292,9 +669,8 @@ def ansible_playbook_directory(request):
 
 
 @pytest.fixture(scope='session')
-def ansible_playbook_inventory(request):
-    path = os.path.abspath(
-        request.config.getoption('--ansible-playbook-inventory'))
+def ansible_playbook_inventory(ansible_playbook_inventory_option):
+    path = os.path.abspath(ansible_playbook_inventory_option)
     assert os.path.isfile(path)
     return path
 
@@ -302,12 +678,19 @@ def ansible_playbook_inventory(request):
 @pytest.fixture(scope='function')
 def ansible_playbook(request, ansible_playbook_directory,
                      ansible_playbook_inventory, session_uuid):
-    pap = PytestAnsiblePlaybook(
-        ansible_playbook_inventory,
-        ansible_playbook_directory,
-        request,
-        session_uuid,
-    )
+    scheduler = getattr(request.config, '_ansible_playbook_prefetch', None)
+    pap = None
+    if scheduler is not None:
+        pap = scheduler.take(
+            request.node, ansible_playbook_inventory, session_uuid)
+    prefetched = pap is not None
+    if not prefetched:
+        pap = get_runner().PytestAnsiblePlaybook(
+            ansible_playbook_inventory,
+            ansible_playbook_directory,
+            request,
+            session_uuid,
+        )
 
     if hasattr(request.node, "iter_markers"):
         skip_teardown = request.node.get_closest_marker(
@@ -319,15 +702,16 @@ def ansible_playbook(request, ansible_playbook_directory,
         if skip_teardown is None:
             skip_teardown = False
 
-    pap.fill_from_markers()
-    with runner(pap, skip_teardown):
+    if not prefetched:
+        pap.fill_from_markers()
+    with pap.lease_hosts(), runner(pap, skip_teardown):
         yield pap
 
 
 @pytest.fixture(scope='session')
 def ansible_playbook_session(request, ansible_playbook_directory,
                      ansible_playbook_inventory, session_uuid):
-    pap = PytestAnsiblePlaybook(
+    pap = get_runner().PytestAnsiblePlaybook(
         ansible_playbook_inventory,
         ansible_playbook_directory,
         request,
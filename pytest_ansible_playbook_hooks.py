@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Hook specifications of pytest-ansible-playbook plugin.
+
+The hooks are called around every playbook run of ``PytestAnsiblePlaybook``,
+including setup and teardown playbooks of the ``ansible_playbook`` fixture,
+so that other plugins (eg. metrics exporters or result caches) can observe
+and short-circuit playbook execution. Implement them in a ``conftest.py``
+file or in a plugin, accepting any subset of the arguments.
+"""
+
+
+import pytest
+
+
+@pytest.hookspec
+def pytest_ansible_playbook_run_start(ansible_playbook, playbook, phase,
+                                      extra_vars):
+    """
+    Called before a playbook run.
+
+    :param ansible_playbook: the ``PytestAnsiblePlaybook`` instance
+    :param playbook: playbook file name, relative to the playbook directory
+    :param phase: ``'setup'``, ``'teardown'`` or ``'call'`` (a run from the
+        test case code)
+    :param extra_vars: dict of extra_vars of the run, don't modify it
+    """
+
+
+@pytest.hookspec(firstresult=True)
+def pytest_ansible_playbook_run_override(ansible_playbook, playbook, phase,
+                                         extra_vars):
+    """
+    Return output of a playbook run to be used instead of running it, or
+    None to run it.
+
+    The output is a dict of lists of task results by host, as returned by
+    ``run_playbook()``, and the run is considered successful. Stops at the
+    first non-None result.
+
+    The arguments are the same as of ``pytest_ansible_playbook_run_start``.
+    """
+
+
+@pytest.hookspec
+def pytest_ansible_playbook_run_finish(ansible_playbook, playbook, phase,
+                                       extra_vars, duration, returncode,
+                                       outputs):
+    """
+    Called after a playbook run, before its return code is checked, also
+    when the run raised an exception (eg. ansible-playbook timed out or
+    the run was not recorded in a strict replay mode).
+
+    :param duration: wall time of the run in seconds, or None when the
+        output was not produced by ansible-playbook (it was replayed or
+        overridden) or when the run raised an exception
+    :param returncode: return code of ansible-playbook, or None when the
+        run raised an exception
+    :param outputs: ``PlaybookResult`` of the run, or None when the run
+        failed without ``skip_errors`` extra var, so that its output was not
+        collected, or when it raised an exception
+
+    The other arguments are the same as of
+    ``pytest_ansible_playbook_run_start``.
+    """
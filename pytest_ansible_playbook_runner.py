@@ -0,0 +1,2394 @@
+# -*- coding: utf-8 -*-
+"""
+Playbook runner machinery of pytest-ansible-playbook plugin.
+
+This module is imported by the plugin on first use only.
+"""
+
+# Copyright 2016 Martin Bukatovič <mbukatov@redhat.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import re
+import copy
+import fcntl
+import glob
+import gzip
+import time
+import uuid
+import shlex
+import shutil
+import hashlib
+import itertools
+import warnings
+import tempfile
+import threading
+import statistics
+import configparser
+import contextlib
+import collections
+import concurrent.futures
+from playbook_runner import playbook_runner
+import subprocess
+import json
+import pytest
+
+
+def get_run_log(config):
+    """
+    Return session wide log of playbook runs, creating it on first use.
+    """
+    run_log = getattr(config, '_ansible_playbook_runs', None)
+    if run_log is None:
+        run_log = RunLog()
+        config._ansible_playbook_runs = run_log
+    return run_log
+
+
+def get_extra_vars_store(config):
+    """
+    Return session wide extra_vars store, creating it on first use.
+    """
+    store = getattr(config, '_ansible_playbook_extra_vars', None)
+    if store is None:
+        store = ExtraVarsStore()
+        config._ansible_playbook_extra_vars = store
+    return store
+
+
+def get_log_spool(config):
+    """
+    Return session wide spool of ansible-playbook output, or None when
+    spooling is not enabled.
+    """
+    return getattr(config, '_ansible_playbook_spool', None)
+
+
+def get_lease_manager(config):
+    """
+    Return session wide manager of host leases, creating it on first use.
+    """
+    manager = getattr(config, '_ansible_playbook_leases', None)
+    if manager is None:
+        manager = LeaseManager(os.path.join(
+            tempfile.gettempdir(),
+            'pytest_ansible_playbook_leases_{0}'.format(os.getuid())))
+        config._ansible_playbook_leases = manager
+    return manager
+
+
+def get_cassettes(config):
+    """
+    Return session wide store of recorded playbook runs, or None when
+    neither recording nor replaying is enabled.
+    """
+    return getattr(config, '_ansible_playbook_cassettes', None)
+
+
+def get_profile(config):
+    """
+    Return session wide performance profile of ansible-playbook runs, or
+    None when no profile is used.
+    """
+    return getattr(config, '_ansible_playbook_profile', None)
+
+
+def get_galaxy_requirements(config):
+    """
+    Return ansible-galaxy requirements installed for the session, or None
+    when no requirements file is used.
+    """
+    return getattr(config, '_ansible_playbook_galaxy', None)
+
+
+def get_concurrency_limit(config):
+    """
+    Return limit of concurrent ansible-playbook runs, or None when the
+    number of concurrent runs is not limited.
+    """
+    return getattr(config, '_ansible_playbook_concurrency', None)
+
+
+def get_deferred_failures(config):
+    """
+    Return session wide list of failed deferred teardowns, creating it on
+    first use.
+    """
+    failures = getattr(config, '_ansible_playbook_deferred_failures', None)
+    if failures is None:
+        failures = []
+        config._ansible_playbook_deferred_failures = failures
+    return failures
+
+
+def report_deferred_failures(terminalreporter, failures):
+    """
+    Report failed deferred teardowns against test cases which registered
+    them.
+    """
+    terminalreporter.write_sep('=', 'ansible-playbook deferred teardowns')
+    for failure in failures:
+        for nodeid in failure['nodeids']:
+            terminalreporter.write_line(
+                'FAILED {0} - deferred teardown playbook ``{1}`` '
+                'failed: {2}'.format(
+                    nodeid, ', '.join(failure['playbooks']),
+                    failure['error']))
+
+
+def get_empty_marker_error(marker_type):
+    """
+    Generate error message for empty marker.
+    """
+    msg = (
+        "no playbook is specified in "
+        "``@pytest.mark.ansible_playbook_{0}`` decorator "
+        "of this test case, please add at least one playbook "
+        "file name as a parameter into the marker, eg. "
+        "``@pytest.mark.ansible_playbook_{0}('playbook.yml')``")
+    return msg.format(marker_type)
+
+
+def get_missing_file_error(marker_type, playbook):
+    """
+        Generate error message for empty marker.
+        """
+    msg = (
+        "no file is specified in "
+        "``@pytest.mark.ansible_playbook_{0}`` decorator "
+        "for the playbook - ``{1}``")
+    return msg.format(marker_type, playbook)
+
+
+def get_defer_scope_error(playbook):
+    """
+    Generate error message for unknown scope of deferred teardown.
+    """
+    msg = (
+        "unknown ``defer`` value of the teardown playbook - ``{0}``, "
+        "expected one of: {1}")
+    return msg.format(playbook, ", ".join(DEFER_SCOPES))
+
+
+def get_lease_pattern_error(pattern):
+    """
+    Generate error message for host pattern of ansible_hosts marker which
+    can't be resolved into hosts.
+    """
+    msg = (
+        "host pattern ``{0}`` of ``@pytest.mark.ansible_hosts`` decorator "
+        "is not supported, please specify a list of group and host names")
+    return msg.format(pattern)
+
+
+def get_cassette_miss_error(play_filename, cassette_path):
+    """
+    Generate error message for playbook run missing in the replayed
+    cassettes.
+    """
+    msg = (
+        "no recorded run of playbook ``{0}`` matches its content, extra_vars "
+        "and inventory, expected cassette file ``{1}``")
+    return msg.format(play_filename, cassette_path)
+
+
+def get_galaxy_install_error(cmd, output):
+    """
+    Generate error message for failed installation of ansible-galaxy
+    requirements.
+    """
+    msg = "installation of ansible-galaxy requirements failed: {0}\n{1}"
+    return msg.format(' '.join(shlex.quote(s) for s in cmd), output)
+
+
+def get_result_statuses(result):
+    """
+    Return statuses of a single task result, as reported by ansible.
+    """
+    statuses = []
+    for status in ('changed', 'failed', 'skipped', 'unreachable'):
+        if result.get(status):
+            statuses.append(status)
+    if not any(s in statuses for s in ('failed', 'skipped', 'unreachable')):
+        statuses.append('ok')
+    return statuses
+
+
+def get_group_hosts(inventory, group):
+    """
+    Return set of hosts of given group of ``ansible-inventory --list``
+    output, including hosts of its child groups.
+    """
+    hosts = set()
+    groups = [group]
+    seen = set()
+    while groups:
+        name = groups.pop()
+        if name in seen or name not in inventory:
+            continue
+        seen.add(name)
+        hosts.update(inventory[name].get('hosts', []))
+        groups.extend(inventory[name].get('children', []))
+    return hosts
+
+
+def get_pattern_hosts(inventory, pattern):
+    """
+    Return set of hosts matched by given ansible host pattern (a list, or a
+    string with names separated by commas or colons), or None when the
+    pattern is not a plain list of group and host names.
+    """
+    if isinstance(pattern, str):
+        pattern = pattern.replace(':', ',').split(',')
+    hosts = set()
+    for name in pattern:
+        name = name.strip()
+        if not name:
+            continue
+        if any(c in name for c in '*?![]&~'):
+            return None
+        if name in inventory:
+            hosts.update(get_group_hosts(inventory, name))
+        else:
+            hosts.add(name)
+    return hosts
+
+
+def get_playbook_hosts_pattern(playbook):
+    """
+    Return hosts declared by a setup or teardown playbook entry, via its
+    ``hosts`` key or ``play_host_groups`` extra var, or None.
+    """
+    if not isinstance(playbook, dict):
+        return None
+    if 'hosts' in playbook:
+        return playbook['hosts']
+    return playbook.get('extra_vars', {}).get('play_host_groups')
+
+
+class PlaybookResult(dict):
+    """
+    Output of a playbook run: a dict of task results per host, in playbook
+    execution order, eg. ``ret['localhost'][0]['msg']``.
+
+    On top of the dict, it provides indexed lookups by host, task name, role
+    and status. Registered results don't carry task metadata, so task and
+    role lookups use the ``task`` and ``role`` keys of a result when present.
+    Indexes and the ``summary`` counters are computed once, when the result
+    is created, so the object should not be modified afterwards.
+    """
+
+    STATUSES = ('ok', 'changed', 'failed', 'skipped', 'unreachable')
+
+    __slots__ = ('summary', 'rusage', '_index')
+
+    def __init__(self, output=None, rusage=None):
+        dict.__init__(self, output or {})
+        # resource usage of the ansible-playbook process, see get_rusage()
+        self.rusage = rusage
+        self.summary = dict.fromkeys(self.STATUSES, 0)
+        # maps ('status'|'task'|'role', value) to (host, position) pairs
+        self._index = {}
+
+        for host, results in self.items():
+            for position, result in enumerate(results):
+                if not isinstance(result, dict):
+                    continue
+                keys = [('status', s) for s in get_result_statuses(result)]
+                for key in ('task', 'role'):
+                    if result.get(key) is not None:
+                        keys.append((key, result[key]))
+                for key in keys:
+                    self._index.setdefault(key, []).append((host, position))
+
+        for status in self.STATUSES:
+            self.summary[status] = len(self._index.get(('status', status), []))
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self), self.rusage))
+
+    def _lookup(self, key, hosts):
+        if hosts is not None:
+            hosts = set(hosts)
+        return [
+            (host, self[host][position])
+            for host, position in self._index.get(key, [])
+            if hosts is None or host in hosts]
+
+    def by_host(self, host):
+        """
+        Return list of task results of given host.
+        """
+        return self.get(host, [])
+
+    def by_status(self, status, hosts=None):
+        """
+        Return list of ``(host, result)`` pairs with given status, one of
+        ``PlaybookResult.STATUSES``, optionally limited to given hosts.
+        """
+        if status not in self.STATUSES:
+            raise ValueError(
+                "unknown task status ``{0}``, expected one of: {1}".format(
+                    status, ", ".join(self.STATUSES)))
+        return self._lookup(('status', status), hosts)
+
+    def by_task(self, name, hosts=None):
+        """
+        Return list of ``(host, result)`` pairs of given task, optionally
+        limited to given hosts.
+        """
+        return self._lookup(('task', name), hosts)
+
+    def by_role(self, role, hosts=None):
+        """
+        Return list of ``(host, result)`` pairs of given role, optionally
+        limited to given hosts.
+        """
+        return self._lookup(('role', role), hosts)
+
+
+def get_file_digest(path):
+    """
+    Return sha1 hex digest of content of given file.
+    """
+    with open(path, 'rb') as content_file:
+        return hashlib.sha1(content_file.read()).hexdigest()
+
+
+def get_extra_vars_signature(extra_vars_dict):
+    """
+    Return signature of extra_vars of a playbook run, which doesn't depend
+    on ``session_uuid``.
+    """
+    extra_vars = dict(extra_vars_dict)
+    extra_vars.pop('session_uuid', None)
+    payload = json.dumps(extra_vars, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def get_slowdown(history, duration):
+    """
+    Return ratio of given duration and median of given history of durations,
+    when the duration is significantly higher than the history, or None.
+    """
+    if len(history) < 3:
+        return None
+    mean = statistics.mean(history)
+    # durations of short playbooks vary a lot relative to their mean, even
+    # when they vary little in between the sessions
+    spread = max(statistics.stdev(history), 0.1 * mean, 0.1)
+    if duration <= mean + 3 * spread:
+        return None
+    return duration / statistics.median(history)
+
+
+def get_rusage(rusage):
+    """
+    Convert ``resource.struct_rusage`` of a child process into a dict.
+    """
+    return {
+        'utime': rusage.ru_utime,
+        'stime': rusage.ru_stime,
+        'maxrss': rusage.ru_maxrss,
+        'nvcsw': rusage.ru_nvcsw,
+        'nivcsw': rusage.ru_nivcsw,
+    }
+
+
+class RusagePopen(subprocess.Popen):
+    """
+    Popen which keeps resource usage of the child process, as reported by
+    ``os.wait4()`` when the process is reaped.
+    """
+
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # the child was reaped elsewhere, the same way as in parent
+            pid, sts = self.pid, 0
+        else:
+            if pid == self.pid:
+                self.rusage = get_rusage(rusage)
+        return (pid, sts)
+
+
+class RunLog(object):
+    """
+    Session wide log of ansible-playbook runs, with resource usage of each
+    run. Records of pytest-xdist workers are merged into the master one.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, playbook, phase, nodeid, returncode, rusage,
+            signature=None, duration=None, queue_wait=None, inventory=None):
+        self.records.append({
+            'playbook': playbook,
+            'inventory': inventory,
+            'phase': phase,
+            'nodeid': nodeid,
+            'returncode': returncode,
+            'rusage': rusage,
+            'signature': signature,
+            'duration': duration,
+            'queue_wait': queue_wait,
+        })
+
+    def report_rusage(self, terminalreporter, top):
+        records = [r for r in self.records if r['rusage'] is not None]
+        records.sort(
+            key=lambda r: r['rusage']['utime'] + r['rusage']['stime'],
+            reverse=True)
+        if top > 0:
+            title = 'top {0} ansible-playbook runs by cpu usage'.format(top)
+            records = records[:top]
+        else:
+            title = 'ansible-playbook runs by cpu usage'
+        terminalreporter.write_sep('=', title)
+        for record in records:
+            rusage = record['rusage']
+            terminalreporter.write_line(
+                '{cpu:.2f}s cpu (user {utime:.2f}s, sys {stime:.2f}s) '
+                '{maxrss} KiB maxrss, {nvcsw}/{nivcsw} ctx switches '
+                '{playbook} ({phase} of {nodeid})'.format(
+                    cpu=rusage['utime'] + rusage['stime'],
+                    playbook=record['playbook'],
+                    phase=record['phase'],
+                    nodeid=record['nodeid'],
+                    **rusage))
+
+    def report_queue_waits(self, terminalreporter, top=10):
+        records = [r for r in self.records if r.get('queue_wait') is not None]
+        records.sort(key=lambda r: r['queue_wait'], reverse=True)
+        terminalreporter.write_sep('=', 'ansible-playbook run queue')
+        terminalreporter.write_line(
+            '{0} ansible-playbook runs waited {1:.2f}s for a free slot '
+            'in total'.format(
+                len(records), sum(r['queue_wait'] for r in records)))
+        for record in records[:top]:
+            if record['queue_wait'] < 0.01:
+                break
+            terminalreporter.write_line(
+                '{queue_wait:.2f}s {playbook} ({phase} of {nodeid})'.format(
+                    **record))
+
+
+class DurationHistory(object):
+    """
+    Wall time history of playbook runs of the last ``size`` sessions, kept
+    in pytest cache.
+
+    Every playbook run is keyed by the playbook file name, signature of its
+    extra_vars and name of the inventory file, so that runs of different
+    inventories given by ``--ansible-playbook-matrix-inventory`` options are
+    kept apart. The history of each key is a fixed size list of mean
+    durations of the key in the last sessions which run it, keys not run in
+    the last ``size`` sessions are dropped.
+    """
+
+    cache_key = 'ansible_playbook/durations'
+
+    def __init__(self, cache, size):
+        self._cache = cache
+        self._size = size
+
+    def update(self, records):
+        """
+        Add durations of given run log records into the history, and return
+        list of playbook runs which are slower than their history.
+        """
+        data = self._cache.get(self.cache_key, None)
+        if data is None:
+            data = {'session': 0, 'playbooks': {}}
+        session = data['session'] + 1
+
+        current = collections.OrderedDict()
+        for record in records:
+            if record.get('duration') is None or record['returncode'] != 0:
+                continue
+            key = '{0}:{1}'.format(record['playbook'], record['signature'])
+            if record.get('inventory') is not None:
+                key = '{0}:{1}'.format(key, record['inventory'])
+            _, durations = current.setdefault(key, (record, []))
+            durations.append(record['duration'])
+
+        playbooks = data['playbooks']
+        slowdowns = []
+        for key, (record, durations) in current.items():
+            duration = statistics.mean(durations)
+            history = playbooks.get(key, [0, []])[1]
+            ratio = get_slowdown(history, duration)
+            if ratio is not None:
+                slowdowns.append({
+                    'playbook': record['playbook'],
+                    'inventory': record.get('inventory'),
+                    'duration': duration,
+                    'baseline': statistics.median(history),
+                    'sessions': len(history),
+                    'ratio': ratio,
+                })
+            history = history + [round(duration, 3)]
+            playbooks[key] = [session, history[-self._size:]]
+
+        data = {
+            'session': session,
+            'playbooks': dict(
+                (key, value) for key, value in playbooks.items()
+                if value[0] > session - self._size),
+        }
+        self._cache.set(self.cache_key, data)
+        return slowdowns
+
+    @staticmethod
+    def report_slowdowns(terminalreporter, slowdowns, threshold):
+        terminalreporter.write_sep('=', 'ansible-playbook slowdowns')
+        for slowdown in sorted(
+                slowdowns, key=lambda s: s['ratio'], reverse=True):
+            failed = threshold is not None and slowdown['ratio'] >= threshold
+            inventory = ''
+            if slowdown.get('inventory') is not None:
+                inventory = ' ({0})'.format(slowdown['inventory'])
+            terminalreporter.write_line(
+                '{failed}{playbook}{inventory_name} {duration:.2f}s, '
+                '{ratio:.1f}x slower than median {baseline:.2f}s of the last '
+                '{sessions} sessions'.format(
+                    failed='FAILED ' if failed else '',
+                    inventory_name=inventory,
+                    **slowdown))
+
+
+class LeaseManager(object):
+    """
+    Read/write leases of ansible hosts, shared by all pytest sessions of the
+    user on this machine, including pytest-xdist workers.
+
+    A lease is a ``flock()`` lock of a file of the host in a shared
+    directory, shared for read leases and exclusive for write leases. Hosts
+    of a test case are always locked in the order of their names, so that
+    test cases waiting for each other's hosts can't deadlock.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._inventories = {}
+        self.records = []
+        os.makedirs(self._path, exist_ok=True)
+
+    def get_lock_path(self, host):
+        name = re.sub(r'[^\w.-]+', '_', host)[:64]
+        digest = hashlib.sha1(host.encode('utf-8')).hexdigest()
+        return os.path.join(
+            self._path, '{0}_{1}.lock'.format(name, digest[:10]))
+
+    def get_hosts(self, pap, pattern):
+        """
+        Return set of hosts of given group and host names, as defined by
+        inventory of given ``PytestAnsiblePlaybook`` instance.
+        """
+        if not pattern:
+            return set()
+        key = pap._ansible_playbook_inventory
+        inventory = self._inventories.get(key)
+        if inventory is None:
+            inventory = self._inventories[key] = pap.get_inventory()
+        hosts = get_pattern_hosts(inventory, pattern)
+        if hosts is None:
+            raise Exception(get_lease_pattern_error(pattern))
+        return hosts
+
+    @contextlib.contextmanager
+    def lease(self, nodeid, exclusive, shared):
+        """
+        Hold write leases of ``exclusive`` and read leases of ``shared``
+        hosts, yielding time spent waiting for them.
+        """
+        modes = dict((host, fcntl.LOCK_SH) for host in shared)
+        modes.update((host, fcntl.LOCK_EX) for host in exclusive)
+        start = time.time()
+        with contextlib.ExitStack() as stack:
+            for host in sorted(modes):
+                lock_file = stack.enter_context(
+                    open(self.get_lock_path(host), 'a'))
+                # the lock is released when the file is closed
+                fcntl.flock(lock_file, modes[host])
+            wait = time.time() - start
+            self.records.append({
+                'nodeid': nodeid,
+                'exclusive': sorted(exclusive),
+                'shared': sorted(set(shared) - set(exclusive)),
+                'wait': wait,
+            })
+            yield wait
+
+    def report_waits(self, terminalreporter, top=10):
+        records = sorted(self.records, key=lambda r: r['wait'], reverse=True)
+        terminalreporter.write_sep('=', 'ansible host leases')
+        terminalreporter.write_line(
+            '{0} test cases waited {1:.2f}s for host leases in total'.format(
+                len(records), sum(r['wait'] for r in records)))
+        for record in records[:top]:
+            if record['wait'] < 0.01:
+                break
+            terminalreporter.write_line(
+                '{wait:.2f}s {nodeid} (exclusive: {exclusive}, '
+                'shared: {shared})'.format(
+                    wait=record['wait'],
+                    nodeid=record['nodeid'],
+                    exclusive=', '.join(record['exclusive']) or '-',
+                    shared=', '.join(record['shared']) or '-'))
+
+
+class CassetteStore(object):
+    """
+    Store of recorded playbook runs (cassettes).
+
+    Every run is keyed by hash of content of the playbook file, its
+    extra_vars (without ``session_uuid``) and content of the inventory.
+    In record mode, return code, output and resource usage of every run are
+    saved into a cassette file. In replay mode, the recorded run is returned
+    instead of running ``ansible-playbook``.
+    """
+
+    def __init__(self, record_path=None, replay_path=None, strict=False):
+        self._record_path = record_path
+        self._replay_path = replay_path
+        self._strict = strict
+        self._digests = {}
+        self._lock = threading.Lock()
+        if record_path is not None:
+            os.makedirs(record_path, exist_ok=True)
+
+    def _get_inventory_digest(self, path):
+        # unlike playbooks, inventory doesn't change during the session
+        with self._lock:
+            digest = self._digests.get(path)
+            if digest is None:
+                if os.path.isfile(path):
+                    digest = get_file_digest(path)
+                else:
+                    digest = path
+                self._digests[path] = digest
+            return digest
+
+    def get_name(self, pap, play_filename, extra_vars_dict):
+        """
+        Return file name of the cassette of given playbook run.
+        """
+        extra_vars = dict(extra_vars_dict)
+        extra_vars.pop('session_uuid', None)
+        payload = json.dumps({
+            'playbook': get_file_digest(os.path.join(
+                pap._ansible_playbook_directory, play_filename)),
+            'extra_vars': extra_vars,
+            'inventory': self._get_inventory_digest(
+                pap._ansible_playbook_inventory),
+            }, sort_keys=True, default=str)
+        digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+        name = re.sub(r'[^\w.-]+', '_', play_filename)[:64]
+        return '{0}-{1}.json'.format(name, digest)
+
+    def load(self, play_filename, name):
+        """
+        Return recorded run, or None when it's not recorded and replay is
+        not strict.
+        """
+        if self._replay_path is None:
+            return None
+        path = os.path.join(self._replay_path, name)
+        if not os.path.isfile(path):
+            if self._strict:
+                raise Exception(get_cassette_miss_error(play_filename, path))
+            return None
+        with open(path) as cassette_file:
+            return json.load(cassette_file)
+
+    def save(self, play_filename, name, returncode, output, rusage):
+        if self._record_path is None:
+            return
+        path = os.path.join(self._record_path, name)
+        tmp_path = '{0}.{1}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as tmp_file:
+            json.dump({
+                'playbook': play_filename,
+                'returncode': returncode,
+                'output': output,
+                'rusage': rusage,
+                }, tmp_file, default=str)
+        os.rename(tmp_path, path)
+
+
+def get_ansible_config(directory):
+    """
+    Return ansible configuration used by ansible processes running in given
+    directory, as a ``ConfigParser``, or None when there is no config file.
+    """
+    paths = [
+        os.environ.get('ANSIBLE_CONFIG'),
+        os.path.join(directory, 'ansible.cfg'),
+        os.path.expanduser('~/.ansible.cfg'),
+        '/etc/ansible/ansible.cfg',
+    ]
+    for path in paths:
+        if path and os.path.isfile(path):
+            parser = configparser.ConfigParser(interpolation=None)
+            parser.read(path)
+            return parser
+    return None
+
+
+class ExecutionProfile(object):
+    """
+    Performance profile of ansible-playbook runs.
+
+    The profile sets number of forks of every run based on the number of
+    hosts in the inventory and the number of CPUs, and overrides execution
+    settings via environment variables. Settings configured explicitly in
+    the ansible config file or in the environment are kept.
+    """
+
+    # name: (environment variable, config sections, value)
+    settings = {
+        'fast': [
+            ('ANSIBLE_STRATEGY', ('defaults',), 'free'),
+            ('ANSIBLE_GATHERING', ('defaults',), 'smart'),
+            ('ANSIBLE_PIPELINING',
+             ('defaults', 'connection', 'ssh_connection'), 'True'),
+        ],
+    }
+
+    # forks per CPU, ansible forks spend most of the time waiting for hosts
+    forks_per_cpu = 16
+
+    def __init__(self, name):
+        self.name = name
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _get_forks(self, pap, config):
+        if config is not None and config.has_option('defaults', 'forks'):
+            return config.getint('defaults', 'forks')
+        if 'ANSIBLE_FORKS' in os.environ:
+            return int(os.environ['ANSIBLE_FORKS'])
+        hosts = get_group_hosts(pap.get_inventory(), 'all')
+        cpus = os.cpu_count() or 1
+        return max(1, min(len(hosts), cpus * self.forks_per_cpu))
+
+    def get_settings(self, pap):
+        """
+        Return number of forks and environment overrides of ansible-playbook
+        runs of given ``PytestAnsiblePlaybook`` instance.
+        """
+        directory = pap._ansible_playbook_directory
+        key = (pap._ansible_playbook_inventory, directory)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            config = get_ansible_config(directory)
+            env = {}
+            for var, sections, value in self.settings[self.name]:
+                option = var[len('ANSIBLE_'):].lower()
+                if var in os.environ or config is not None and any(
+                        config.has_option(section, option)
+                        for section in sections):
+                    continue
+                env[var] = value
+            forks = self._get_forks(pap, config)
+            overrides = ' '.join(
+                '{0}={1}'.format(var, env[var]) for var in sorted(env))
+            playbook_runner.LOGGER.info(
+                'ansible-playbook profile {0}: forks={1} {2}'.format(
+                    self.name, forks, overrides))
+            self._cache[key] = forks, env
+            return forks, env
+
+
+class GalaxyRequirements(object):
+    """
+    Roles and collections of an ansible-galaxy requirements file, installed
+    into a cache directory shared by pytest sessions and pytest-xdist
+    workers.
+
+    The requirements are installed into a subdirectory named by hash of
+    content of the requirements file, under a lock, so that only the first
+    session installs them and an unchanged file costs nothing. Every ansible
+    process then finds them via ``ANSIBLE_ROLES_PATH`` and
+    ``ANSIBLE_COLLECTIONS_PATH`` environment variables.
+    """
+
+    # name: (environment variable, config option, default paths)
+    paths = collections.OrderedDict([
+        ('roles', (
+            'ANSIBLE_ROLES_PATH',
+            'roles_path',
+            '~/.ansible/roles:/usr/share/ansible/roles:/etc/ansible/roles')),
+        ('collections', (
+            'ANSIBLE_COLLECTIONS_PATH',
+            'collections_path',
+            '~/.ansible/collections:/usr/share/ansible/collections')),
+    ])
+
+    def __init__(self, requirements_path, cache_path, directory):
+        self._requirements_path = os.path.abspath(requirements_path)
+        self._directory = directory
+        digest = get_file_digest(self._requirements_path)
+        self.path = os.path.join(cache_path, digest[:16])
+        self._env = None
+
+    def _has_collections(self):
+        with open(self._requirements_path) as requirements_file:
+            content = requirements_file.read()
+        return re.search(r'^collections\s*:', content, re.M) is not None
+
+    def install(self):
+        """
+        Install the requirements unless they are installed already, return
+        True when they have been installed.
+        """
+        installed_path = os.path.join(self.path, '.installed')
+        with open('{0}.lock'.format(self.path), 'a') as lock_file:
+            # the lock is released when the file is closed
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if os.path.isfile(installed_path):
+                return False
+            shutil.rmtree(self.path, ignore_errors=True)
+            cmds = [['ansible-galaxy', 'role', 'install']]
+            if self._has_collections():
+                cmds.append(['ansible-galaxy', 'collection', 'install'])
+            for cmd, name in zip(cmds, self.paths):
+                cmd += [
+                    '-r', self._requirements_path,
+                    '-p', os.path.join(self.path, name),
+                ]
+                proc = subprocess.run(
+                    cmd,
+                    cwd=self._directory,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT)
+                if proc.returncode != 0:
+                    shutil.rmtree(self.path, ignore_errors=True)
+                    raise pytest.UsageError(get_galaxy_install_error(
+                        cmd, proc.stdout.decode('utf-8', 'replace')))
+            with open(installed_path, 'w'):
+                pass
+            return True
+
+    def get_env(self):
+        """
+        Return environment variables which make ansible find the installed
+        requirements before the configured roles and collections.
+        """
+        if self._env is not None:
+            return self._env
+        config = get_ansible_config(self._directory)
+        env = {}
+        for name, (var, option, default) in self.paths.items():
+            if var in os.environ:
+                configured = os.environ[var]
+            elif config is not None and config.has_option('defaults', option):
+                configured = config.get('defaults', option)
+            elif config is not None and \
+                    config.has_option('defaults', option + 's'):
+                configured = config.get('defaults', option + 's')
+            else:
+                configured = default
+            env[var] = os.pathsep.join([
+                os.path.join(self.path, name), configured])
+        self._env = env
+        return env
+
+
+class ConcurrencyLimit(object):
+    """
+    Semaphore limiting number of concurrent ansible-playbook runs of all
+    pytest sessions of the user on this machine, including pytest-xdist
+    workers and threads.
+
+    Each of the ``slots`` is a ``flock()`` lock of a file in a shared
+    directory. Waiting runs are queued via ticket files in the same
+    directory, named by priority and time of enqueueing, and only the run
+    at the head of the queue may take a free slot, so that runs get the
+    slots in FIFO order, with teardown runs first. A ticket is locked by its
+    owner, so that tickets of killed processes are detected and dropped.
+    """
+
+    poll_interval = 0.02
+
+    def __init__(self, slots, path=None):
+        if path is None:
+            path = os.path.join(
+                tempfile.gettempdir(),
+                'pytest_ansible_playbook_slots_{0}'.format(os.getuid()))
+        self._path = path
+        self._slots = slots
+        os.makedirs(self._path, exist_ok=True)
+
+    def _enqueue(self, priority):
+        """
+        Create locked ticket file of given priority, return it and its name.
+        """
+        name = '{0}-{1:020d}-{2}-{3}.ticket'.format(
+            priority, int(time.time() * 1e6), os.getpid(),
+            threading.get_ident())
+        tmp_path = os.path.join(self._path, '{0}.tmp'.format(name))
+        ticket = open(tmp_path, 'w')
+        fcntl.flock(ticket, fcntl.LOCK_EX)
+        # the ticket is visible to others only when it's locked already
+        os.rename(tmp_path, os.path.join(self._path, name))
+        return ticket, name
+
+    def _is_stale(self, name):
+        path = os.path.join(self._path, name)
+        try:
+            ticket = open(path)
+        except FileNotFoundError:
+            return True
+        with ticket:
+            try:
+                fcntl.flock(ticket, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        return True
+
+    def _is_first(self, name):
+        for other in sorted(os.listdir(self._path)):
+            if other == name:
+                return True
+            if other.endswith('.ticket') and not self._is_stale(other):
+                return False
+        return False
+
+    def _try_acquire(self):
+        for index in range(self._slots):
+            slot_file = open(
+                os.path.join(self._path, 'slot_{0}.lock'.format(index)), 'a')
+            try:
+                fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                slot_file.close()
+            else:
+                return slot_file
+        return None
+
+    @contextlib.contextmanager
+    def slot(self, teardown=False):
+        """
+        Hold a slot of a run, yielding time spent waiting for it.
+        """
+        start = time.time()
+        ticket, name = self._enqueue(0 if teardown else 1)
+        slot_file = None
+        try:
+            while slot_file is None:
+                if self._is_first(name):
+                    slot_file = self._try_acquire()
+                if slot_file is None:
+                    time.sleep(self.poll_interval)
+        finally:
+            os.remove(os.path.join(self._path, name))
+            ticket.close()
+        # the slot is released when the file is closed
+        with slot_file:
+            yield time.time() - start
+
+
+class ExtraVarsStore(object):
+    """
+    Session wide directory of extra_vars files.
+
+    Each distinct extra_vars payload is written only once, into a file named
+    by the hash of its content, so that it can be passed to
+    ``ansible-playbook`` as ``--extra-vars @file`` instead of on the command
+    line. Identical payloads of different tests and phases share the file.
+    Static inventory files of ``Inventory`` objects are stored the same way.
+    """
+
+    def __init__(self):
+        self._path = None
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def get_file(self, extra_vars_dict):
+        payload = json.dumps(extra_vars_dict, sort_keys=True, default=str)
+        digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+        with self._lock:
+            file_path = self._files.get(digest)
+            if file_path is not None:
+                return file_path
+
+            if self._path is None:
+                self._path = tempfile.mkdtemp(
+                    prefix='pytest_ansible_playbook_vars_')
+            file_path = os.path.join(self._path, '{0}.json'.format(digest))
+            tmp_path = '{0}.tmp'.format(file_path)
+            with open(tmp_path, 'w') as tmp_file:
+                tmp_file.write(payload)
+            os.rename(tmp_path, file_path)
+
+            self._files[digest] = file_path
+            return file_path
+
+    def cleanup(self):
+        if self._path is not None:
+            shutil.rmtree(self._path, ignore_errors=True)
+        self._path = None
+        self._files = {}
+
+
+class TailBuffer(object):
+    """
+    Ring buffer keeping the last ``size`` bytes written into it.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._chunks = collections.deque()
+        self._length = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._length += len(data)
+        while self._length - len(self._chunks[0]) >= self._size:
+            self._length -= len(self._chunks.popleft())
+
+    def getvalue(self):
+        data = b''.join(self._chunks)
+        if len(data) <= self._size:
+            return data
+        # drop the incomplete first line
+        data = data[-self._size:]
+        return data[data.find(b'\n') + 1:]
+
+
+class SpoolFile(object):
+    """
+    Compressed log of all ansible-playbook runs of a single test, with the
+    tail of the output kept in memory.
+    """
+
+    def __init__(self, path, tail_size):
+        self.path = path
+        self.tail = TailBuffer(tail_size)
+        self.failed = False
+        self.reported = False
+        self._tail_size = tail_size
+        self._lock = threading.Lock()
+
+    chunk_size = 64 * 1024
+
+    def stream(self, output, header):
+        """
+        Copy given binary stream into the log in chunks, until it's closed.
+
+        The stream is compressed into a gzip member file of its own, which
+        is appended to the log (and its tail to the tail of the log) when
+        the stream is closed, so that concurrent runs of the same test don't
+        wait for each other while their output is being written.
+        """
+        chunks = iter(lambda: output.read1(self.chunk_size), b'')
+        tail = TailBuffer(self._tail_size)
+        fd, member_path = tempfile.mkstemp(
+            prefix='{0}.'.format(os.path.basename(self.path)),
+            suffix='.part',
+            dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'wb') as raw_file, \
+                    gzip.GzipFile(fileobj=raw_file, mode='wb') as member_file:
+                for chunk in itertools.chain([header.encode('utf-8')], chunks):
+                    member_file.write(chunk)
+                    tail.write(chunk)
+            with self._lock:
+                with open(member_path, 'rb') as member_file, \
+                        open(self.path, 'ab') as log_file:
+                    shutil.copyfileobj(member_file, log_file)
+                self.tail.write(tail.getvalue())
+        finally:
+            os.remove(member_path)
+
+
+class LogSpool(object):
+    """
+    Session wide spool of ansible-playbook output.
+
+    Output of every run is streamed in chunks into a gzip compressed file of
+    the test the run belongs to, so that memory usage doesn't depend on the
+    size of the output. The tail of the output and the path of the full log
+    are attached to the test report when the test or any of its playbooks
+    fails, otherwise the log is deleted when the test finishes.
+    """
+
+    def __init__(self, path, tail_size):
+        self._path = os.path.abspath(path)
+        self._tail_size = tail_size
+        self._files = {}
+        self._lock = threading.Lock()
+        os.makedirs(self._path, exist_ok=True)
+
+    def _get_file_name(self, nodeid):
+        name = re.sub(r'[^\w.-]+', '_', nodeid).strip('_')
+        if len(name) > 100:
+            digest = hashlib.sha1(nodeid.encode('utf-8')).hexdigest()
+            name = '{0}_{1}'.format(name[:100], digest[:10])
+        return '{0}.log.gz'.format(name)
+
+    def get_file(self, nodeid):
+        with self._lock:
+            spool_file = self._files.get(nodeid)
+            if spool_file is None:
+                path = os.path.join(self._path, self._get_file_name(nodeid))
+                spool_file = self._files[nodeid] = SpoolFile(
+                    path, self._tail_size)
+            return spool_file
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+        report = outcome.get_result()
+        with self._lock:
+            spool_file = self._files.get(item.nodeid)
+            if spool_file is not None and call.when == 'teardown':
+                del self._files[item.nodeid]
+        if spool_file is None:
+            return
+        if report.failed:
+            spool_file.failed = True
+        # a playbook failure ignored via skip_errors is reported once, with
+        # the teardown phase
+        if report.failed or call.when == 'teardown' and \
+                spool_file.failed and not spool_file.reported:
+            spool_file.reported = True
+            tail = spool_file.tail.getvalue().decode('utf-8', 'replace')
+            report.sections.append((
+                'ansible-playbook output tail ({0}), full log: {1}'.format(
+                    call.when, spool_file.path),
+                tail))
+        if call.when != 'teardown':
+            return
+        user_properties = getattr(item, 'user_properties', None)
+        if spool_file.failed and user_properties is not None:
+            user_properties.append(('ansible_playbook_log', spool_file.path))
+        elif not spool_file.failed and os.path.isfile(spool_file.path):
+            os.remove(spool_file.path)
+
+    def close(self):
+        # logs of deferred teardowns, which don't belong to any test
+        for spool_file in self._files.values():
+            if not spool_file.failed and os.path.isfile(spool_file.path):
+                os.remove(spool_file.path)
+        self._files = {}
+
+
+TRACE_CALLBACK_NAME = 'pytest_ansible_playbook_trace'
+
+# ansible callback plugin which records start and end time of every task on
+# every host into file given by PYTEST_ANSIBLE_PLAYBOOK_TRACE_EVENTS
+TRACE_CALLBACK_SOURCE = '''\
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = '{0}'
+    CALLBACK_NEEDS_ENABLED = False
+    CALLBACK_NEEDS_WHITELIST = False
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self._path = os.environ.get('PYTEST_ANSIBLE_PLAYBOOK_TRACE_EVENTS')
+        self._starts = {{}}
+        self._events = []
+
+    def v2_runner_on_start(self, host, task):
+        self._starts[(host.get_name(), task._uuid)] = time.time()
+
+    def _record(self, result, status):
+        host = result._host.get_name()
+        task = result._task
+        end = time.time()
+        start = self._starts.pop((host, task._uuid), end)
+        role = task._role.get_name() if task._role is not None else None
+        self._events.append({{
+            'host': host,
+            'task': task.get_name(),
+            'role': role,
+            'status': status,
+            'start': start,
+            'end': end,
+        }})
+
+    def v2_runner_on_ok(self, result):
+        self._record(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record(result, 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self._record(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self._record(result, 'unreachable')
+
+    def v2_playbook_on_stats(self, stats):
+        if not self._path:
+            return
+        with open(self._path, 'w') as events_file:
+            json.dump(self._events, events_file)
+'''.format(TRACE_CALLBACK_NAME)
+
+
+class TraceRecorder(object):
+    """
+    Session wide recorder of a timeline of tests, setup and teardown phases,
+    playbook runs and ansible tasks, written in Chrome trace event format
+    (loadable in Perfetto or ``about:tracing``).
+
+    Every pytest-xdist worker writes its own file next to the requested one,
+    which are merged into the requested file by the master at session end.
+    """
+
+    def __init__(self, path, worker_id):
+        self._path = os.path.abspath(path)
+        self._worker_id = worker_id
+        if worker_id != 'master':
+            self._file_path = '{0}.{1}'.format(self._path, worker_id)
+        else:
+            self._file_path = self._path
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._tmp_path = None
+        self._host_tids = {}
+        self._file = open(self._file_path, 'w', buffering=1024 * 1024)
+        self._separator = '[\n'
+        self._add_metadata('process_name', self._pid, {
+            'name': 'pytest {0}'.format(worker_id),
+        })
+
+    def _write(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self._file.write(self._separator)
+            self._file.write(line)
+            self._separator = ',\n'
+
+    def _add_metadata(self, name, tid, args):
+        self._write({
+            'name': name,
+            'ph': 'M',
+            'pid': self._pid,
+            'tid': tid,
+            'args': args,
+        })
+
+    def _get_host_tid(self, host):
+        with self._lock:
+            tid = self._host_tids.get(host)
+            if tid is not None:
+                return tid
+            tid = self._host_tids[host] = -1 - len(self._host_tids)
+        self._add_metadata('thread_name', tid, {'name': host})
+        return tid
+
+    def add_span(self, name, category, start, end, tid=None, **args):
+        args['worker'] = self._worker_id
+        self._write({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': self._pid,
+            'tid': threading.current_thread().ident if tid is None else tid,
+            'args': args,
+        })
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, time.time(), **args)
+
+    def get_task_events_env(self):
+        """
+        Return environment variables which make ``ansible-playbook`` record
+        task events, and path of the file the events are written into.
+        """
+        with self._lock:
+            if self._tmp_path is None:
+                self._tmp_path = tempfile.mkdtemp(
+                    prefix='pytest_ansible_playbook_trace_')
+                callback_path = os.path.join(
+                    self._tmp_path, '{0}.py'.format(TRACE_CALLBACK_NAME))
+                with open(callback_path, 'w') as callback_file:
+                    callback_file.write(TRACE_CALLBACK_SOURCE)
+        events_path = os.path.join(
+            self._tmp_path, '{0}.json'.format(uuid.uuid4().hex))
+        callback_paths = [self._tmp_path]
+        if os.environ.get('ANSIBLE_CALLBACK_PLUGINS'):
+            callback_paths.append(os.environ['ANSIBLE_CALLBACK_PLUGINS'])
+        env = {
+            'ANSIBLE_CALLBACK_PLUGINS': os.pathsep.join(callback_paths),
+            'PYTEST_ANSIBLE_PLAYBOOK_TRACE_EVENTS': events_path,
+        }
+        return env, events_path
+
+    def add_task_events(self, events_path, **args):
+        """
+        Add task events recorded by ``ansible-playbook`` into the trace.
+        """
+        if not os.path.isfile(events_path):
+            return
+        with open(events_path) as events_file:
+            events = json.load(events_file)
+        os.remove(events_path)
+        for event in events:
+            self.add_span(
+                event['task'],
+                'task',
+                event['start'],
+                event['end'],
+                tid=self._get_host_tid(event['host']),
+                host=event['host'],
+                role=event['role'],
+                status=event['status'],
+                **args)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        with self.span(item.nodeid, 'test'):
+            yield
+
+    def close(self):
+        if self._worker_id == 'master':
+            # merge traces of pytest-xdist workers, if any
+            for worker_path in glob.glob('{0}.gw*'.format(self._path)):
+                with open(worker_path) as worker_file:
+                    events = json.load(worker_file)
+                for event in events:
+                    self._write(event)
+                os.remove(worker_path)
+        self._file.write('\n]\n')
+        self._file.close()
+        if self._tmp_path is not None:
+            shutil.rmtree(self._tmp_path, ignore_errors=True)
+
+
+class Inventory(object):
+    """
+    Ansible inventory defined in python, which can be used instead of an
+    inventory file path by ``fixture_runner()`` or by overriding
+    ``ansible_playbook_inventory`` fixture.
+
+    It's written once per session into a static json inventory file, used by
+    all playbook runs, while ``get_inventory()`` answers from memory.
+
+    :param hosts: dict of host names and their variables, or list of hosts
+    :param groups: dict of group names and dicts with optional ``hosts``,
+        ``children`` (lists of names) and ``vars`` (dict) keys
+    :param vars: variables of ``all`` group
+    """
+
+    def __init__(self, hosts=None, groups=None, vars=None):
+        if hosts is None:
+            hosts = {}
+        elif not isinstance(hosts, dict):
+            hosts = dict((host, {}) for host in hosts)
+        self.hosts = hosts
+        self.groups = groups or {}
+        self.vars = vars or {}
+        self._list = None
+        self._data = None
+        self._store = None
+        self._path = None
+
+    def _get_host_names(self):
+        names = list(self.hosts)
+        for group in self.groups.values():
+            for host in group.get('hosts', []):
+                if host not in names:
+                    names.append(host)
+        return names
+
+    def get_data(self):
+        """
+        Return the inventory in the format of ansible yaml inventory plugin.
+        """
+        if self._data is not None:
+            return self._data
+        children = {}
+        for name, group in self.groups.items():
+            children[name] = {
+                'hosts': dict((h, {}) for h in group.get('hosts', [])),
+                'children': dict((c, {}) for c in group.get('children', [])),
+                'vars': group.get('vars', {}),
+            }
+        self._data = {
+            'all': {
+                'hosts': dict(
+                    (h, self.hosts.get(h) or {})
+                    for h in self._get_host_names()),
+                'children': children,
+                'vars': self.vars,
+            },
+        }
+        return self._data
+
+    def get_list(self):
+        """
+        Return the inventory in the format of ``ansible-inventory --list``.
+        """
+        if self._list is not None:
+            return self._list
+        names = self._get_host_names()
+        child_groups = set()
+        for group in self.groups.values():
+            child_groups.update(group.get('children', []))
+
+        inventory = {}
+        grouped = set()
+        for name, group in self.groups.items():
+            inventory[name] = {}
+            if group.get('hosts'):
+                inventory[name]['hosts'] = list(group['hosts'])
+                grouped.update(group['hosts'])
+            if group.get('children'):
+                inventory[name]['children'] = list(group['children'])
+        ungrouped = [h for h in names if h not in grouped]
+        top_groups = [g for g in self.groups if g not in child_groups]
+        inventory['all'] = {'children': ['ungrouped'] + top_groups}
+        inventory['ungrouped'] = {'hosts': ungrouped} if ungrouped else {}
+
+        group_hosts = dict(
+            (name, get_group_hosts(inventory, name)) for name in self.groups)
+        hostvars = {}
+        for host in names:
+            host_vars = dict(self.vars)
+            for name, group in self.groups.items():
+                if host in group_hosts[name]:
+                    host_vars.update(group.get('vars', {}))
+            host_vars.update(self.hosts.get(host) or {})
+            hostvars[host] = host_vars
+        inventory['_meta'] = {'hostvars': hostvars}
+
+        self._list = inventory
+        return self._list
+
+    def get_path(self, store):
+        """
+        Return path of static inventory file in given session store.
+        """
+        if self._store is not store:
+            self._path = store.get_file(self.get_data())
+            self._store = store
+        return self._path
+
+
+# request of a test item which is not running yet, see PrefetchScheduler,
+# or of a scope node, see DeferredTeardowns
+ItemRequest = collections.namedtuple('ItemRequest', ['node', 'config'])
+
+DEFER_SCOPES = ('module', 'session')
+
+# default extra_vars of playbook runs, the same as of playbook_runner
+PLAYBOOK_DEFAULTS = (
+    ('skip_errors', False),
+    ('gather_facts_for_pb', False),
+    ('play_host_groups', 'localhost'),
+    ('fork_factor', 50),
+    ('max_timeout', 120),
+    ('strace', False),
+)
+
+# hooks called around every playbook run, see pytest_ansible_playbook_hooks
+RUN_HOOK_NAMES = (
+    'pytest_ansible_playbook_run_start',
+    'pytest_ansible_playbook_run_override',
+    'pytest_ansible_playbook_run_finish',
+)
+
+
+def is_node_active(node):
+    """
+    Return True when given collection node is set up and not being torn
+    down, so that finalizers can be added to it.
+    """
+    setupstate = getattr(node.session, '_setupstate', None)
+    stack = getattr(setupstate, 'stack', None)
+    if stack is None:
+        return True
+    return node in stack
+
+
+class DeferredTeardowns(object):
+    """
+    Teardown playbooks deferred until the end of a module or session.
+
+    The playbooks are run when the scope node is finalized, batched by
+    their extra_vars: playbooks with the same extra_vars are run in a single
+    ``ansible-playbook`` invocation of a generated playbook importing all of
+    them, in the order they were registered.
+
+    A failure of a batch is not raised from the finalizer, which would make
+    pytest report it as an error of whichever test case happens to be the
+    last one of the scope, but it's reported against the test cases which
+    registered the failed playbooks at the end of the session, which then
+    fails. It can't be added into ``user_properties`` of the test cases,
+    since their reports are done already.
+    """
+
+    def __init__(self, pap_class, inventory, directory, request, session_uuid):
+        self._pap_class = pap_class
+        self._inventory = inventory
+        self._directory = directory
+        self._request = request
+        self._session_uuid = session_uuid
+        self._batches = collections.OrderedDict()
+
+    def add(self, play_filename, extra_vars, nodeid):
+        key = json.dumps(extra_vars, sort_keys=True, default=str)
+        _, entries = self._batches.setdefault(key, (extra_vars, []))
+        entries.append((play_filename, nodeid))
+
+    def run(self):
+        batches, self._batches = self._batches, collections.OrderedDict()
+        if not batches:
+            return
+        pap = self._pap_class(
+            self._inventory,
+            self._directory,
+            self._request,
+            self._session_uuid,
+        )
+        pap._phase = 'teardown'
+        for i, (extra_vars, entries) in enumerate(batches.values()):
+            play_filename = self._get_batch_playbook(pap, i, entries)
+            play_name = pap._play_names.get(play_filename, play_filename)
+            try:
+                pap.outputs['teardown'][play_name] = \
+                    pap.run_playbook(play_filename, extra_vars)
+            except Exception as ex:
+                self._add_failure(entries, ex)
+
+    def _add_failure(self, entries, ex):
+        nodeids = collections.OrderedDict(
+            (nodeid, None) for _, nodeid in entries)
+        get_deferred_failures(self._request.config).append({
+            'playbooks': [play_filename for play_filename, _ in entries],
+            'nodeids': list(nodeids),
+            'error': repr(ex),
+        })
+
+    def _get_batch_playbook(self, pap, index, entries):
+        """
+        Return playbook file name which runs all playbooks of a batch.
+
+        A generated playbook is recorded under names of the batched
+        playbooks joined by ``+``, rather than its temporary path.
+        """
+        if len(entries) == 1:
+            return entries[0][0]
+        play_path = os.path.join(
+            pap._path_str, 'deferred_teardown_{0}.yml'.format(index))
+        with open(play_path, 'w') as play_file:
+            play_file.write('---\n')
+            for play_filename, _ in entries:
+                play_file.write('- import_playbook: {0}\n'.format(
+                    json.dumps(os.path.join(self._directory, play_filename))))
+        pap._play_names[play_path] = ' + '.join(
+            play_filename for play_filename, _ in entries)
+        return play_path
+
+
+def get_inventory_param(item):
+    """
+    Return inventory given by ``--ansible-playbook-matrix-inventory`` option
+    the given test item is parametrized by, or None.
+    """
+    callspec = getattr(item, 'callspec', None)
+    if callspec is None:
+        return None
+    return callspec.params.get('ansible_playbook_inventory_option')
+
+
+def is_same_inventory(item, other):
+    """
+    Return True when given test items use the same inventory, ie. the same
+    inventory given by ``--ansible-playbook-matrix-inventory`` options and
+    the same ``ansible_playbook_inventory`` fixture.
+    """
+    if get_inventory_param(item) != get_inventory_param(other):
+        return False
+    name = 'ansible_playbook_inventory'
+    fixturedefs = item._fixtureinfo.name2fixturedefs.get(name)
+    other_fixturedefs = other._fixtureinfo.name2fixturedefs.get(name)
+    if not fixturedefs or not other_fixturedefs:
+        return False
+    return fixturedefs[-1] is other_fixturedefs[-1]
+
+
+class PrefetchScheduler(object):
+    """
+    Runs setup playbooks of the next test case in background, while the
+    current test case runs, when hosts declared by the setup playbooks of
+    the next test case don't overlap with hosts declared by the setup and
+    teardown playbooks of the current one, nor with hosts it leases via
+    ``ansible_hosts`` marker.
+
+    Both test cases have to use ``ansible_playbook`` fixture. The fixture of
+    the next test case then takes over the prefetched instance and joins
+    its setup instead of running it again.
+    """
+
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._prefetched = {}
+        self._nextitem = None
+        # inventories by path, test cases of different inventories given by
+        # --ansible-playbook-matrix-inventory options use different ones
+        self._inventories = {}
+
+    def _get_inventory(self, pap):
+        inventory = self._inventories.get(pap._ansible_playbook_inventory)
+        if inventory is None:
+            inventory = pap.get_inventory()
+            self._inventories[pap._ansible_playbook_inventory] = inventory
+        return inventory
+
+    def _get_hosts(self, pap, playbooks):
+        """
+        Return set of hosts declared by given playbook entries, or None when
+        any of them doesn't declare its hosts.
+        """
+        inventory = self._get_inventory(pap)
+        hosts = set()
+        for playbook in playbooks:
+            pattern = get_playbook_hosts_pattern(playbook)
+            if pattern is None:
+                return None
+            pattern_hosts = get_pattern_hosts(inventory, pattern)
+            if pattern_hosts is None:
+                return None
+            hosts.update(pattern_hosts)
+        return hosts
+
+    def _get_lease_hosts(self, pap, item):
+        """
+        Return set of hosts leased by given test item via ``ansible_hosts``
+        marker, both exclusive and shared, or None when they can't be
+        resolved.
+        """
+        marker = item.get_closest_marker('ansible_hosts')
+        if marker is None:
+            return set()
+        inventory = self._get_inventory(pap)
+        hosts = set()
+        for kind in ('exclusive', 'shared'):
+            pattern = marker.kwargs.get(kind)
+            if not pattern:
+                continue
+            pattern_hosts = get_pattern_hosts(inventory, pattern)
+            if pattern_hosts is None:
+                return None
+            hosts.update(pattern_hosts)
+        return hosts
+
+    def _prefetch(self, item, nextitem):
+        current = item.funcargs['ansible_playbook']
+        pap = current.__class__(
+            current._inventory_source,
+            current._ansible_playbook_directory,
+            ItemRequest(nextitem, nextitem.config),
+            current.session_uuid,
+        )
+        try:
+            pap.fill_from_markers()
+        except Exception:
+            # reported by the fixture of the next test case
+            return
+        if not pap._setup_playbooks:
+            return
+
+        next_hosts = self._get_hosts(current, pap._setup_playbooks)
+        if next_hosts is None:
+            return
+        current_hosts = self._get_hosts(
+            current, current._setup_playbooks + current._teardown_playbooks)
+        if current_hosts is None:
+            return
+        # the current test case holds leases of these hosts until its end
+        lease_hosts = self._get_lease_hosts(current, item)
+        if lease_hosts is None or (current_hosts | lease_hosts) & next_hosts:
+            return
+
+        pap._prefetched = self._executor.submit(
+            pap._run_phase, 'setup', pap._setup_playbooks)
+        self._prefetched[nextitem.nodeid] = pap
+
+    def take(self, item, inventory, session_uuid):
+        """
+        Return prefetched instance for given test item, if any, and if it
+        uses given inventory and session uuid of the item.
+        """
+        pap = self._prefetched.pop(item.nodeid, None)
+        if pap is None:
+            return None
+        if pap._inventory_source != inventory or \
+                pap.session_uuid != session_uuid:
+            self._discard(item.nodeid, pap)
+            return None
+        return pap
+
+    def _discard(self, nodeid, pap):
+        """
+        Clean up prefetched setup which is not used by its test case via
+        its teardown playbooks.
+        """
+        try:
+            pap.setup()
+            pap.teardown()
+        except Exception as ex:
+            warnings.warn(
+                "teardown of prefetched setup of {0} failed: {1}".format(
+                    nodeid, ex),
+                RuntimeWarning)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        self._nextitem = nextitem
+        yield
+        pap = self._prefetched.pop(item.nodeid, None)
+        if pap is not None:
+            # the test case didn't use the prefetched setup, eg. because it
+            # has been skipped
+            self._discard(item.nodeid, pap)
+
+    # before session scoped fixtures are finalized
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_sessionfinish(self, session):
+        # the session stopped before the test case of the prefetched setup,
+        # eg. because of -x option or KeyboardInterrupt
+        prefetched, self._prefetched = self._prefetched, {}
+        for nodeid, pap in prefetched.items():
+            self._discard(nodeid, pap)
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_runtest_call(self, item):
+        nextitem = self._nextitem
+        if nextitem is None or nextitem.nodeid in self._prefetched:
+            return
+        if 'ansible_playbook' not in getattr(item, 'funcargs', {}):
+            return
+        if 'ansible_playbook' not in getattr(nextitem, 'fixturenames', []):
+            return
+        # the prefetched instance uses inventory and session uuid of the
+        # current test case
+        if not is_same_inventory(item, nextitem):
+            return
+        # setup of test cases with host leases has to wait for the leases
+        if any(nextitem.iter_markers('skip')) or \
+                any(nextitem.iter_markers('skipif')) or \
+                any(nextitem.iter_markers('ansible_hosts')):
+            return
+        self._prefetch(item, nextitem)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class PytestAnsiblePlaybook(playbook_runner.AnsiblePlaybook):
+    def __init__(self, ansible_playbook_inventory, ansible_playbook_directory,
+                 request, session_uuid=None):
+        # path of inventory file or Inventory object
+        self._inventory_source = ansible_playbook_inventory
+        self._extra_vars_store = get_extra_vars_store(request.config)
+        if isinstance(ansible_playbook_inventory, Inventory):
+            ansible_playbook_inventory = ansible_playbook_inventory.get_path(
+                self._extra_vars_store)
+        playbook_runner.AnsiblePlaybook.__init__(
+            self,
+            ansible_playbook_inventory,
+            ansible_playbook_directory,
+        )
+
+        self._request = request
+        self._setup_playbooks = []
+        self._teardown_playbooks = []
+
+        self.session_uuid = session_uuid
+        self.outputs = {
+            'setup': {},
+            'teardown': {},
+        }
+        self._inventory = None
+        if isinstance(self._inventory_source, Inventory):
+            self._inventory = self._inventory_source.get_list()
+        self._tracer = getattr(request.config, '_ansible_playbook_trace', None)
+        self._run_log = get_run_log(request.config)
+        self._spool = get_log_spool(request.config)
+        self._cassettes = get_cassettes(request.config)
+        self._profile = get_profile(request.config)
+        self._galaxy = get_galaxy_requirements(request.config)
+        self._concurrency = get_concurrency_limit(request.config)
+        # forks of the next run given by the profile
+        self._forks = None
+        self._phase = 'call'
+        # setup running in background, see PrefetchScheduler
+        self._prefetched = None
+        # names runs of generated playbooks are recorded under, by their path
+        self._play_names = {}
+
+    def _get_ansible_cmd(self, inventory_file, playbook_file, extra_vars_dict):
+        """
+        Return process args list for ansible-playbook run, with extra_vars
+        passed via a content addressed file.
+
+        The per instance ``playbooks_output_path`` is kept on the command
+        line, so that the file is shared by all instances of a session.
+        """
+        file_vars = dict(extra_vars_dict)
+        output_path = file_vars.pop('playbooks_output_path', None)
+
+        # let the parent build the rest of the command without serializing
+        # the whole payload into the command line
+        cmd = playbook_runner.AnsiblePlaybook._get_ansible_cmd(
+            inventory_file,
+            playbook_file,
+            {
+                'fork_factor': extra_vars_dict['fork_factor'],
+                'strace': extra_vars_dict['strace'],
+            },
+        )
+        if self._forks is not None:
+            cmd[cmd.index('--fork') + 1] = str(self._forks)
+        index = cmd.index('--extra-vars') + 1
+        cmd[index] = '@{0}'.format(self._extra_vars_store.get_file(file_vars))
+        if output_path is not None:
+            cmd[index + 1:index + 1] = [
+                '--extra-vars',
+                json.dumps({'playbooks_output_path': output_path}),
+            ]
+
+        return cmd
+
+    def _generate_parent_play(self, dir_path, play_filename):
+        """
+        Generate parent playbook of given playbook, which may be also in a
+        subdirectory or given by an absolute path.
+        """
+        play_dirname, play_basename = os.path.split(play_filename)
+        return playbook_runner.AnsiblePlaybook._generate_parent_play(
+            self, os.path.join(dir_path, play_dirname), play_basename)
+
+    def _get_ansible_env(self, cmd):
+        """
+        Return environment of given ansible process.
+        """
+        env = os.environ.copy()
+        env['ANSIBLE_HOST_KEY_CHECKING'] = 'False'
+        if self._galaxy is not None:
+            env.update(self._galaxy.get_env())
+        if self._profile is not None and 'ansible-playbook' in cmd:
+            env.update(self._profile.get_settings(self)[1])
+        return env
+
+    def _run_subprocess_ansible(self, cmd, skip_errors, timeout):
+        """
+        Run given ansible command the same way as the parent class does, in
+        environment returned by ``_get_ansible_env()``.
+        """
+        cmd_for_log = ' '.join(shlex.quote(s) for s in cmd)
+        run_id = uuid.uuid4().hex
+        ansible_output_path = '{0}/ansible_output_path.txt'.format(
+            self._path_str)
+
+        env = self._get_ansible_env(cmd)
+        task_events_path = None
+        if self._tracer is not None and 'ansible-playbook' in cmd:
+            trace_env, task_events_path = self._tracer.get_task_events_env()
+            env.update(trace_env)
+
+        err = False
+        result = None
+        with open(ansible_output_path, 'a+') as output_file:
+            output_file.write(
+                'Going to run:\n{0}\nrun_id: {1}\n'.format(
+                    cmd_for_log, run_id))
+            try:
+                result = self._run_process(cmd, timeout, env)
+            except Exception:
+                self._exception_logger.exception(
+                    'Failed executing subprocess for '
+                    'run_id: {0}\ncmd: {1}\n'.format(run_id, cmd_for_log))
+                err = True
+            finally:
+                if result and result.stdout is None:
+                    output_file.write('OUTPUT spooled into:\n{0}\n\n\n'.format(
+                        self._spool.get_file(self._request.node.nodeid).path))
+                if result and result.stdout:
+                    output_file.write('STDOUT:\n{0}\n'.format(
+                        result.stdout.decode('utf-8')))
+                if result and result.stderr:
+                    output_file.write('STDERR:\n{0}\n\n\n'.format(
+                        result.stderr.decode('utf-8')))
+                if task_events_path is not None:
+                    self._tracer.add_task_events(
+                        task_events_path, session_uuid=self.session_uuid)
+
+        if err or (not skip_errors and result.returncode != 0):
+            playbook_runner.LOGGER.error(
+                'Failed to run:\n{0}\nrun_id: {1}\n'
+                'Check exception log for details'.format(cmd_for_log, run_id))
+
+        return err, result
+
+    def _run_process(self, cmd, timeout, env):
+        """
+        Run given command like ``subprocess.run()`` does. Resource usage
+        and wall time of ansible-playbook processes are kept in ``rusage``
+        and ``duration`` attributes of the result (None for other commands).
+
+        Only the ansible-playbook process is timed, so that the duration
+        doesn't include ``ansible --list-hosts`` run on the first run of the
+        instance.
+
+        When spooling is enabled, output of ansible-playbook processes is
+        streamed into the spool file of the test instead, and both
+        ``stdout`` and ``stderr`` of the result are None.
+        """
+        spool_file = None
+        if self._spool is not None and 'ansible-playbook' in cmd:
+            spool_file = self._spool.get_file(self._request.node.nodeid)
+        start = time.time()
+        with RusagePopen(
+                cmd,
+                cwd=self._ansible_playbook_directory,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE if spool_file is None
+                else subprocess.STDOUT,
+                env=env) as proc:
+            try:
+                if spool_file is None:
+                    stdout, stderr = proc.communicate(timeout=timeout)
+                else:
+                    stdout = stderr = None
+                    self._spool_process(proc, spool_file, timeout)
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                raise
+        result = subprocess.CompletedProcess(
+            proc.args, proc.returncode, stdout, stderr)
+        result.rusage = result.duration = None
+        if 'ansible-playbook' in cmd:
+            result.rusage = proc.rusage
+            result.duration = time.time() - start
+        return result
+
+    def _spool_process(self, proc, spool_file, timeout):
+        """
+        Stream output of given process into given spool file, killing the
+        process when it doesn't finish in time.
+        """
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, expire)
+        timer.start()
+        try:
+            spool_file.stream(proc.stdout, 'Going to run:\n{0}\n'.format(
+                ' '.join(shlex.quote(s) for s in proc.args)))
+            proc.wait()
+        finally:
+            timer.cancel()
+        if expired.is_set():
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        if proc.returncode != 0:
+            spool_file.failed = True
+
+    @contextlib.contextmanager
+    def _run_slot(self):
+        """
+        Hold a slot of a playbook run when the number of concurrent runs is
+        limited, yielding time spent waiting for it, or None.
+        """
+        if self._concurrency is None:
+            yield None
+            return
+        with contextlib.ExitStack() as stack:
+            with self._trace_span('queue', 'phase'):
+                queue_wait = stack.enter_context(
+                    self._concurrency.slot(self._phase == 'teardown'))
+            yield queue_wait
+
+    def _trace_span(self, name, category, **args):
+        """
+        Return context manager recording a span of the trace, when enabled.
+        """
+        if self._tracer is None:
+            return contextlib.ExitStack()
+        return self._tracer.span(
+            name, category, session_uuid=self.session_uuid, **args)
+
+    def _get_hosts_by_group(self, inventory, group):
+        """
+        Return hosts of given group, without running ansible for inventory
+        defined in python.
+        """
+        if isinstance(self._inventory_source, Inventory):
+            return sorted(get_group_hosts(self.get_inventory(), group))
+        return playbook_runner.AnsiblePlaybook._get_hosts_by_group(
+            self, inventory, group)
+
+    def get_inventory(self):
+        if self._inventory is not None:
+            return self._inventory
+
+        cmd = [
+                'ansible-inventory',
+                '-i',
+                self._ansible_playbook_inventory,
+                '--list'
+                ]
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        proc.wait(timeout=60)
+        stdout, stderr = proc.communicate(timeout=10)
+        self._inventory = json.loads(stdout.decode('utf-8'))
+        return self._inventory
+
+    def get_group_hosts(self, group):
+        """
+        Return set of hosts of given inventory group, including hosts of
+        its child groups.
+        """
+        return get_group_hosts(self.get_inventory(), group)
+
+    def lease_hosts(self):
+        """
+        Return context manager holding leases of hosts declared via
+        ``ansible_hosts`` marker of the test case, if any.
+        """
+        node = self._request.node
+        if hasattr(node, "iter_markers"):
+            marker = node.get_closest_marker('ansible_hosts')
+        else:
+            marker = node.get_marker('ansible_hosts')
+        if marker is None:
+            return contextlib.ExitStack()
+        manager = get_lease_manager(self._request.config)
+        return self._lease_hosts(
+            manager,
+            manager.get_hosts(self, marker.kwargs.get('exclusive')),
+            manager.get_hosts(self, marker.kwargs.get('shared')))
+
+    @contextlib.contextmanager
+    def _lease_hosts(self, manager, exclusive, shared):
+        node = self._request.node
+        with contextlib.ExitStack() as stack:
+            with self._trace_span('lease', 'phase'):
+                wait = stack.enter_context(
+                    manager.lease(node.nodeid, exclusive, shared))
+            user_properties = getattr(node, 'user_properties', None)
+            if user_properties is not None:
+                user_properties.append(('ansible_hosts_wait', wait))
+            yield
+
+    def add_to_teardown(self, element):
+        self._teardown_playbooks.append(element)
+
+    def fill_from_custom(self, setup, teardown):
+        self._setup_playbooks = setup
+        self._teardown_playbooks = teardown
+
+    def fill_from_markers(self):
+        if hasattr(self._request.node, "iter_markers"):
+            # since pytest 4.0.0, markers api changed, see:
+            # https://github.com/pytest-dev/pytest/pull/4564
+            # https://docs.pytest.org/en/latest/mark.html#updating-code
+            setup_ms = self._request.node.iter_markers(
+                'ansible_playbook_setup')
+            teardown_ms = self._request.node.iter_markers(
+                'ansible_playbook_teardown')
+        else:
+            marker = self._request.node.get_marker('ansible_playbook_setup')
+            setup_ms = [marker] if marker is not None else []
+            marker = self._request.node.get_marker('ansible_playbook_teardown')
+            teardown_ms = [marker] if marker is not None else []
+
+        for marker in setup_ms:
+            if len(marker.args) == 0:
+                raise Exception(get_empty_marker_error("setup"))
+            # extend because multiple mark entries are supported
+            self._setup_playbooks.extend(marker.args)
+        for marker in teardown_ms:
+            if len(marker.args) == 0:
+                raise Exception(get_empty_marker_error("teardown"))
+            # extend because multiple mark entries are supported
+            self._teardown_playbooks.extend(list(marker.args))
+
+    def run_playbook(self, play_filename, extra_vars_dict=None):
+        if extra_vars_dict is None:
+            extra_vars_dict = {}
+        hook = self._get_run_hook()
+        hook_args = {
+            'ansible_playbook': self,
+            'playbook': play_filename,
+            'phase': self._phase,
+            'extra_vars': extra_vars_dict,
+        }
+        play_name = self._play_names.get(play_filename, play_filename)
+        with self._trace_span(play_name, 'playbook'):
+            recorded = None
+            if hook is not None:
+                hook.pytest_ansible_playbook_run_start(**hook_args)
+                override = hook.pytest_ansible_playbook_run_override(
+                    **hook_args)
+                if override is not None:
+                    recorded = {
+                        'returncode': 0,
+                        'rusage': None,
+                        'output': override,
+                    }
+            check_ret = 'skip_errors' not in extra_vars_dict or \
+                not extra_vars_dict['skip_errors']
+            # all None when the run raises an exception
+            ret = result = duration = None
+            try:
+                ret, result, duration = self._run_or_replay(
+                    play_filename, play_name, extra_vars_dict, recorded,
+                    check_ret)
+            finally:
+                if hook is not None:
+                    hook.pytest_ansible_playbook_run_finish(
+                        duration=duration, returncode=ret, outputs=result,
+                        **hook_args)
+            if check_ret:
+                assert ret == 0
+            return result
+
+    def _run_or_replay(self, play_filename, play_name, extra_vars_dict,
+                       recorded, check_ret):
+        """
+        Replay given recorded run or the run recorded in a cassette, if any,
+        or run given playbook, and return return code, ``PlaybookResult``
+        (None when the failed run is to be checked) and wall time of the
+        run.
+        """
+        if recorded is None and self._cassettes is not None:
+            cassette = self._cassettes.get_name(
+                self, play_filename, extra_vars_dict)
+            recorded = self._cassettes.load(play_filename, cassette)
+        duration = queue_wait = None
+        if recorded is not None:
+            ret = recorded['returncode']
+            rusage = recorded['rusage']
+        else:
+            self._forks = None
+            if self._profile is not None and \
+                    'fork_factor' not in extra_vars_dict:
+                self._forks = self._profile.get_settings(self)[0]
+            with self._run_slot() as queue_wait:
+                process = self._run_ansible_playbook(
+                    play_filename, extra_vars_dict)
+            ret = process.returncode
+            rusage = process.rusage
+            duration = process.duration
+        self._record_run(
+            play_name, ret, extra_vars_dict, rusage, duration, queue_wait)
+
+        result = None
+        if recorded is not None:
+            result = PlaybookResult(recorded['output'], rusage)
+        elif ret == 0 or not check_ret:
+            output = self.get_output()
+            if self._cassettes is not None:
+                self._cassettes.save(
+                    play_filename, cassette, ret, output, rusage)
+            result = PlaybookResult(output, rusage)
+        return ret, result, duration
+
+    def _run_ansible_playbook(self, play_filename, extra_vars_dict):
+        """
+        Run given playbook the same way as ``run_playbook()`` of the parent
+        class does, but return the completed ansible-playbook process
+        instead of its return code, so that its resource usage and wall time
+        are not passed via the instance, which can run more playbooks
+        concurrently.
+        """
+        local_extra_vars = copy.deepcopy(extra_vars_dict)
+        local_extra_vars['playbooks_output_path'] = self._path_str
+        for key, value in PLAYBOOK_DEFAULTS:
+            local_extra_vars.setdefault(key, value)
+
+        if not self._hosts:
+            local_hosts = ['localhost', '127.0.0.1']
+            hosts = self._get_hosts_by_group(
+                self._ansible_playbook_inventory, 'all')
+            group = local_extra_vars['play_host_groups']
+            if not hosts and group not in local_hosts:
+                raise RuntimeError(
+                    'Failed to list hosts. Will use localhost only')
+            hosts.extend(local_hosts)
+            self._hosts.update(hosts)
+
+        path = self._generate_parent_play(
+            self._ansible_playbook_directory, play_filename)
+        cmd = self._get_ansible_cmd(
+            self._ansible_playbook_inventory,
+            path,
+            extra_vars_dict=local_extra_vars)
+
+        for host in self._hosts:
+            file_path = '{0}/{1}.json'.format(self._path_str, host)
+            if not os.path.isfile(file_path):
+                with open(file_path, 'w') as host_file:
+                    host_file.write('[')
+
+        err, result = self._run_subprocess_ansible(
+            cmd,
+            local_extra_vars['skip_errors'],
+            local_extra_vars['max_timeout'])
+        if err:
+            raise RuntimeError('Failed to run playbook view exception log')
+        return result
+
+    def _get_run_hook(self):
+        """
+        Return pytest hook relay when any of the playbook run hooks is
+        implemented, or None, so that the hooks cost nothing otherwise.
+        """
+        hook = self._request.config.hook
+        for name in RUN_HOOK_NAMES:
+            if getattr(hook, name).get_hookimpls():
+                return hook
+        return None
+
+    def _record_run(self, play_filename, returncode, extra_vars_dict,
+                    rusage, duration, queue_wait):
+        """
+        Record resource usage, wall time and queue wait of a playbook run
+        into the session log, and resource usage into user properties of the
+        test report.
+        """
+        node = self._request.node
+        inventory = None
+        if self._ansible_playbook_inventory is not None:
+            inventory = os.path.basename(self._ansible_playbook_inventory)
+        self._run_log.add(
+            play_filename, self._phase, node.nodeid, returncode,
+            rusage, get_extra_vars_signature(extra_vars_dict),
+            duration, queue_wait, inventory)
+        user_properties = getattr(node, 'user_properties', None)
+        if user_properties is not None and rusage is not None:
+            user_properties.append((
+                'ansible_playbook_rusage',
+                {
+                    'playbook': play_filename,
+                    'phase': self._phase,
+                    'rusage': rusage,
+                }))
+
+    def setup(self):
+        if self._prefetched is not None:
+            # join setup started in background by PrefetchScheduler
+            prefetched, self._prefetched = self._prefetched, None
+            prefetched.result()
+            return
+        self._run_phase('setup', self._setup_playbooks)
+
+    def teardown(self):
+        self._run_phase('teardown', self._teardown_playbooks)
+
+    def _run_phase(self, phase, playbooks):
+        self._phase = phase
+        try:
+            with self._trace_span(phase, 'phase'):
+                for playbook in playbooks:
+                    if 'file' not in playbook:
+                        raise Exception(
+                            get_missing_file_error(phase, playbook))
+
+                    extra_vars = {"session_uuid": self.session_uuid}
+                    if 'extra_vars' in playbook:
+                        for k, v in playbook['extra_vars'].items():
+                            extra_vars[k] = v
+
+                    if phase == 'teardown' and playbook.get('defer') and \
+                            self._defer_teardown(playbook, extra_vars):
+                        continue
+
+                    self.outputs[phase][playbook['file']] = \
+                        self.run_playbook(playbook['file'], extra_vars)
+        finally:
+            self._phase = 'call'
+
+    def _defer_teardown(self, playbook, extra_vars):
+        """
+        Queue teardown playbook to be run at the end of module or session,
+        as specified by its ``defer`` key, and return True, or return False
+        when the module or session is being torn down already (eg. the
+        teardown is done by a fixture of the same scope), so that the
+        playbook has to be run right away.
+        """
+        scope = playbook['defer']
+        if scope not in DEFER_SCOPES:
+            raise Exception(get_defer_scope_error(playbook))
+        node = self._request.node
+        scope_node = None
+        if scope == 'module':
+            scope_node = node.getparent(pytest.Module)
+        if scope_node is None:
+            scope_node = node.session
+        if not is_node_active(scope_node):
+            return False
+
+        # test cases of different inventories given by more
+        # --ansible-playbook-matrix-inventory options have separate queues
+        queues = getattr(scope_node, '_ansible_playbook_deferred', None)
+        if queues is None:
+            queues = scope_node._ansible_playbook_deferred = {}
+        key = (self._ansible_playbook_inventory, self.session_uuid)
+        deferred = queues.get(key)
+        if deferred is None:
+            deferred = DeferredTeardowns(
+                self.__class__,
+                self._inventory_source,
+                self._ansible_playbook_directory,
+                ItemRequest(scope_node, self._request.config),
+                self.session_uuid,
+            )
+            queues[key] = deferred
+            scope_node.addfinalizer(deferred.run)
+        deferred.add(playbook['file'], extra_vars, node.nodeid)
+        return True
@@ -23,8 +23,12 @@ setup(
     description='Pytest fixture which runs given ansible playbook file.',
     long_description=read('README.md'),
     long_description_content_type='text/markdown',
-    py_modules=['pytest_ansible_playbook'],
-    install_requires=['pytest>=3.1.0', 'playbook_runner>=0.1.5'],
+    py_modules=[
+        'pytest_ansible_playbook',
+        'pytest_ansible_playbook_hooks',
+        'pytest_ansible_playbook_runner',
+    ],
+    install_requires=['pytest>=3.1.0', 'playbook_runner>=0.2.15'],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Framework :: Pytest',
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark of pytest-ansible-playbook plugin.
+
+Measures time of ``pytest --collect-only`` of a generated test suite which
+doesn't use the plugin:
+
+* without the plugin,
+* with the plugin loaded (it should be the same as without it),
+* with the plugin and its runner machinery imported eagerly, to show what
+  the lazy import saves.
+
+Usage: python tests/bench_startup.py [--runs N] [--tests N]
+"""
+
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VARIANTS = [
+    ('without plugin', []),
+    ('with plugin', ['-p', 'pytest_ansible_playbook']),
+    ('with eager runner import', [
+        '-p', 'pytest_ansible_playbook',
+        '-p', 'pytest_ansible_playbook_runner',
+    ]),
+]
+
+
+def make_suite(path, tests):
+    with open(os.path.join(path, 'test_bench.py'), 'w') as test_file:
+        for i in range(tests):
+            test_file.write('def test_{0}():\n    pass\n\n\n'.format(i))
+
+
+def measure(path, args, runs):
+    env = os.environ.copy()
+    # plugins are loaded explicitly only, via -p options
+    env['PYTEST_DISABLE_PLUGIN_AUTOLOAD'] = '1'
+    env.pop('PYTEST_PLUGINS', None)
+    env['PYTHONPATH'] = os.pathsep.join(
+        p for p in (ROOT, env.get('PYTHONPATH')) if p)
+    cmd = [
+        sys.executable, '-m', 'pytest', '--collect-only', '-q',
+        '-p', 'no:cacheprovider',
+    ] + args
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            cmd, cwd=path, env=env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--tests', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(
+            prefix='pytest_ansible_playbook_bench_') as path:
+        make_suite(path, args.tests)
+        # warm up filesystem and bytecode caches
+        for _, variant_args in VARIANTS:
+            measure(path, variant_args, 1)
+        for name, variant_args in VARIANTS:
+            timings = measure(path, variant_args, args.runs)
+            print('{0:<26} median {1:.3f}s  min {2:.3f}s'.format(
+                name, statistics.median(timings), min(timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,16 @@ def inventory(testdir):
     return inventory
 
 
+@pytest.fixture
+def local_inventory(testdir):
+    """
+    Create ansible inventory file with localhost reachable via local
+    connection, so that no ssh access is needed for any play.
+    """
+    inventory = testdir.makefile(".ini", "localhost ansible_connection=local")
+    return inventory
+
+
 @pytest.fixture
 def minimal_playbook(testdir):
     """
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 
+import textwrap
+
 import pytest
 
 
@@ -15,6 +17,21 @@ def test_help_message(testdir):
         'ansible-playbook:',
         '*--ansible-playbook-directory=PLAYBOOK_DIR*',
         '*--ansible-playbook-inventory=INVENTORY_FILE*',
+        '*--ansible-playbook-matrix-inventory=INVENTORY_FILE*',
+        '*--ansible-playbook-inventory-lanes*',
+        '*--ansible-playbook-trace=TRACE_FILE*',
+        '*--ansible-playbook-rusage=N*',
+        '*--ansible-playbook-max-concurrent=N*',
+        '*--ansible-playbook-prefetch*',
+        '*--ansible-playbook-spool=SPOOL_DIR*',
+        '*--ansible-playbook-spool-tail=KB*',
+        '*--ansible-playbook-record=CASSETTE_DIR*',
+        '*--ansible-playbook-replay=CASSETTE_DIR*',
+        '*--ansible-playbook-replay-strict*',
+        '*--ansible-playbook-profile=PROFILE*',
+        '*--ansible-playbook-requirements=REQUIREMENTS_FILE*',
+        '*--ansible-playbook-history=N*',
+        '*--ansible-playbook-slowdown-threshold=RATIO*',
         ])
 
 
@@ -83,3 +100,22 @@ def test_invalid_options(testdir, dir_value, dir_error, inv_value, inv_error):
         assert result.ret == 5
     else:
         assert result.ret == 4
+
+
+def test_lazy_loading(testdir):
+    """
+    Make sure that the playbook runner machinery is not imported when the
+    plugin is loaded, but no test case uses it.
+    """
+    testdir.makepyfile(textwrap.dedent("""\
+        import sys
+
+        def test_foo():
+            assert 'pytest_ansible_playbook' in sys.modules
+            assert 'pytest_ansible_playbook_runner' not in sys.modules
+            assert 'playbook_runner' not in sys.modules
+        """))
+    # run in a subprocess, since this process has the runner imported already
+    result = testdir.runpytest_subprocess('-p', 'pytest_ansible_playbook')
+    result.stdout.fnmatch_lines(['*1 passed*'])
+    assert result.ret == 0
@@ -1,7 +1,12 @@
 # -*- coding: utf8 -*-
 
 
+import os
+import gzip
+import json
+import tarfile
 import textwrap
+import subprocess
 
 import pytest
 
@@ -188,3 +193,1271 @@ def test_customfixture_sessionscope_teardown_checkfile(
             assert content == exp_content + "\n"
     # make sure that that we get a '0' exit code for the testsuite
     assert result.ret == 0
+
+
+def test_extra_vars_file(testdir, local_inventory):
+    """
+    Make sure that extra_vars are passed to ``ansible-playbook`` via content
+    addressed file, keeping their types, and that identical payloads reuse
+    the same file.
+    """
+    playbook = testdir.makefile(
+        ".yml",
+        "---",
+        "- hosts: all",
+        "  connection: local",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - copy:",
+        "       content: '{{ payload.hosts | length }}'",
+        "       dest: '{{ dest }}'",
+        )
+    test_file_path = os.path.join(playbook.dirname, "test_file.txt")
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import os
+
+        def test_bar(request, ansible_playbook):
+            extra_vars = {{
+                'payload': {{'hosts': ['a', 'b', 'c']}},
+                'dest': '{1}',
+            }}
+            ansible_playbook.run_playbook('{0}', extra_vars)
+            ansible_playbook.run_playbook('{0}', extra_vars)
+            store = request.config._ansible_playbook_extra_vars
+            assert len(os.listdir(store._path)) == 1
+        """.format(playbook.basename, test_file_path)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_bar PASSED*',
+        ])
+    # check that the nested variable reached the playbook as a dict
+    with open(test_file_path, 'r') as test_file_object:
+        assert test_file_object.read() == "3"
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+
+
+def test_trace(testdir, local_inventory, minimal_playbook):
+    """
+    Make sure that ``--ansible-playbook-trace`` option writes spans of tests,
+    phases, playbooks and ansible tasks in Chrome trace event format.
+    """
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        @pytest.mark.ansible_playbook_setup({0})
+        def test_foo(ansible_playbook):
+            ansible_playbook.run_playbook('{1}')
+        """.format(
+            {'file': minimal_playbook.basename}, minimal_playbook.basename)))
+    trace_path = os.path.join(minimal_playbook.dirname, "trace.json")
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '--ansible-playbook-trace={0}'.format(trace_path),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_foo PASSED*',
+        ])
+    with open(trace_path, 'r') as trace_file:
+        events = json.load(trace_file)
+    spans = [e for e in events if e['ph'] == 'X']
+    assert sorted(set(e['cat'] for e in spans)) == \
+        ['phase', 'playbook', 'task', 'test']
+    tasks = [e for e in spans if e['cat'] == 'task']
+    # ping task of both the setup and in-test playbook runs
+    assert len([e for e in tasks if e['name'] == 'ping']) == 2
+    assert all(e['args']['host'] == 'localhost' for e in tasks)
+    assert all(e['args']['worker'] == 'master' for e in spans)
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+
+
+def test_rusage(testdir, local_inventory, minimal_playbook):
+    """
+    Make sure that resource usage of ansible-playbook processes is attached
+    to playbook outputs and reported by ``--ansible-playbook-rusage`` option.
+    """
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        @pytest.mark.ansible_playbook_setup({0})
+        def test_foo(request, ansible_playbook):
+            ret = ansible_playbook.run_playbook('{1}')
+            assert ret.rusage['utime'] > 0
+            assert ret.rusage['maxrss'] > 0
+            setup_ret = ansible_playbook.outputs['setup']['{1}']
+            assert setup_ret.rusage['utime'] > 0
+            props = [
+                v for k, v in request.node.user_properties
+                if k == 'ansible_playbook_rusage']
+            assert [p['phase'] for p in props] == ['setup', 'call']
+        """.format(
+            {'file': minimal_playbook.basename}, minimal_playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '--ansible-playbook-rusage=1',
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_foo PASSED*',
+        '*top 1 ansible-playbook runs by cpu usage*',
+        '*s cpu *{0} (* of *::test_foo)'.format(minimal_playbook.basename),
+        ])
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+
+
+@pytest.mark.parametrize("first_marker, prefetched", [
+    ("", True),
+    ("@pytest.mark.ansible_playbook_teardown("
+     "{{'file': '{playbook}', 'hosts': ['localhost']}})", False),
+    ("@pytest.mark.ansible_hosts(exclusive='localhost')", False),
+    ("@pytest.mark.ansible_hosts(shared='all')", False),
+    ])
+def test_prefetch(testdir, local_inventory, first_marker, prefetched):
+    """
+    Make sure that with ``--ansible-playbook-prefetch`` option, setup
+    playbooks of the next test case are started in background during the
+    current test case, only when their declared hosts don't overlap with
+    hosts of the current test case.
+    """
+    test_file_path = os.path.join(str(testdir.tmpdir), "prefetched.txt")
+    playbook = testdir.makefile(
+        ".yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - copy:",
+        "       content: prefetched",
+        "       dest: {0}".format(test_file_path),
+        )
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import os
+        import time
+
+        import pytest
+
+        {marker}
+        def test_one(request, ansible_playbook):
+            scheduler = request.config._ansible_playbook_prefetch
+            if {prefetched}:
+                assert list(scheduler._prefetched) == [
+                    'test_prefetch.py::test_two']
+                # setup of test_two runs while this test case runs
+                for _ in range(60):
+                    if os.path.exists('{path}'):
+                        break
+                    time.sleep(0.5)
+                assert os.path.exists('{path}')
+            else:
+                assert scheduler._prefetched == {{}}
+
+        @pytest.mark.ansible_playbook_setup({{
+            'file': '{playbook}', 'hosts': 'localhost'}})
+        def test_two(ansible_playbook):
+            assert os.path.exists('{path}')
+        """.format(
+            marker=first_marker.format(playbook=playbook.basename),
+            prefetched=prefetched,
+            path=test_file_path,
+            playbook=playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '--ansible-playbook-prefetch',
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_one PASSED*',
+        '*::test_two PASSED*',
+        ])
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+
+
+def test_prefetch_session_stopped(testdir, local_inventory):
+    """
+    Make sure that prefetched setup of a test case which is not run because
+    the session stopped early is cleaned up by its teardown playbooks.
+    """
+    test_file_path = os.path.join(str(testdir.tmpdir), "prefetched.txt")
+    setup = testdir.makefile(
+        ".setup.yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - copy:",
+        "       content: prefetched",
+        "       dest: {0}".format(test_file_path),
+        )
+    teardown = testdir.makefile(
+        ".teardown.yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - file:",
+        "       path: {0}".format(test_file_path),
+        "       state: absent",
+        )
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import os
+        import time
+
+        import pytest
+
+        def test_one(ansible_playbook):
+            for _ in range(60):
+                if os.path.exists('{path}'):
+                    break
+                time.sleep(0.5)
+            assert 0
+
+        @pytest.mark.ansible_playbook_setup(
+            {{'file': '{setup}', 'hosts': 'localhost'}})
+        @pytest.mark.ansible_playbook_teardown({{'file': '{teardown}'}})
+        def test_two(ansible_playbook):
+            pass
+        """.format(
+            path=test_file_path,
+            setup=setup.basename,
+            teardown=teardown.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(setup.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '--ansible-playbook-prefetch',
+        '-x',
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_one FAILED*',
+        '*1 failed*',
+        ])
+    assert not os.path.exists(test_file_path)
+    # make sure that that we get a '1' exit code for the testsuite
+    assert result.ret == 1
+
+
+def test_deferred_teardown(testdir, local_inventory):
+    """
+    Make sure that teardown playbooks with ``defer`` key are run at the end
+    of the module, batched into a single ``ansible-playbook`` run.
+    """
+    playbooks = []
+    for name in ("one", "two"):
+        file_path = os.path.join(str(testdir.tmpdir), name + ".txt")
+        playbook = testdir.makefile(
+            "." + name + ".yml",
+            "---",
+            "- hosts: all",
+            "  gather_facts: no",
+            "  tasks:",
+            "   - copy:",
+            "       content: '{{ content }}'",
+            "       dest: " + file_path,
+            )
+        playbooks.append((playbook.basename, file_path))
+    teardown = [
+        {'file': basename, 'defer': 'module', 'extra_vars': {'content': 'x'}}
+        for basename, _ in playbooks]
+    testdir.makepyfile(test_module=textwrap.dedent("""\
+        import os
+
+        import pytest
+
+        @pytest.mark.ansible_playbook_teardown({0})
+        def test_one(ansible_playbook):
+            pass
+
+        def test_two(ansible_playbook):
+            ansible_playbook.add_to_teardown({1})
+            # teardown of test_one is deferred
+            assert not os.path.exists('{2}')
+        """.format(teardown[0], teardown[1], playbooks[0][1])))
+    testdir.makepyfile(test_summary=textwrap.dedent("""\
+        import os
+
+        def test_check(request):
+            assert os.path.exists('{0}')
+            assert os.path.exists('{1}')
+            records = [
+                r for r in request.config._ansible_playbook_runs.records
+                if r['nodeid'] == 'test_module.py']
+            assert len(records) == 1
+            assert records[0]['phase'] == 'teardown'
+            assert records[0]['playbook'] == '{2} + {3}'
+        """.format(
+            playbooks[0][1], playbooks[1][1],
+            playbooks[0][0], playbooks[1][0])))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(testdir.tmpdir),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '-v',
+        'test_module.py',
+        'test_summary.py',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_one PASSED*',
+        '*::test_two PASSED*',
+        '*::test_check PASSED*',
+        ])
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+
+
+def test_deferred_teardown_scoped_fixtures(testdir, local_inventory):
+    """
+    Make sure that teardown playbooks deferred to the scope of the fixture
+    which registered them (module scoped fixture with ``fixture_runner``,
+    ``ansible_playbook_session``) are run when the fixture is torn down.
+    """
+    log_path = os.path.join(str(testdir.tmpdir), "teardowns.txt")
+    playbook = testdir.makefile(
+        ".yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - lineinfile:",
+        "       path: {0}".format(log_path),
+        "       line: '{{ name }}'",
+        "       create: yes",
+        )
+
+    def get_teardown(name, scope):
+        return {
+            'file': playbook.basename,
+            'defer': scope,
+            'extra_vars': {'name': name},
+        }
+
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        from pytest_ansible_playbook import fixture_runner
+
+        @pytest.fixture(scope='module')
+        def module_fixture(request):
+            with fixture_runner(request, [], [{module}]) as pap:
+                yield pap
+
+        @pytest.mark.ansible_playbook_teardown({function})
+        def test_one(module_fixture, ansible_playbook):
+            pass
+
+        def test_two(module_fixture, ansible_playbook_session):
+            ansible_playbook_session.add_to_teardown({session})
+        """.format(
+            module=get_teardown('module', 'module'),
+            function=get_teardown('function', 'module'),
+            session=get_teardown('session', 'session'))))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_one PASSED*',
+        '*::test_two PASSED*',
+        ])
+    assert 'ERROR' not in result.stdout.str()
+    assert result.ret == 0
+    with open(log_path) as log_file:
+        assert log_file.read().split() == ['function', 'module', 'session']
+
+
+def test_deferred_teardown_error(testdir, local_inventory, broken_playbook):
+    """
+    Make sure that failure of a deferred teardown playbook is reported
+    against test cases which registered it, not against the last test case
+    of the scope, and that it fails the session.
+    """
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        @pytest.mark.ansible_playbook_teardown({0})
+        def test_one(ansible_playbook):
+            pass
+
+        def test_two():
+            pass
+        """.format({'file': broken_playbook.basename, 'defer': 'session'})))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(broken_playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_one PASSED*',
+        '*::test_two PASSED*',
+        '*ansible-playbook deferred teardowns*',
+        'FAILED *::test_one - deferred teardown playbook ``{0}`` '
+        'failed: *'.format(broken_playbook.basename),
+        ])
+    assert 'ERROR' not in result.stdout.str()
+    assert result.ret == 1
+
+
+def test_python_inventory(testdir):
+    """
+    Make sure that inventory defined in python can be used instead of
+    inventory file, without running ``ansible-inventory``.
+    """
+    test_file_path = os.path.join(str(testdir.tmpdir), "inventory.txt")
+    playbook = testdir.makefile(
+        ".inventory.yml",
+        "---",
+        "- hosts: web",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - copy:",
+        "       content: '{{ color }} {{ size }}'",
+        "       dest: " + test_file_path,
+        )
+    testdir.makeconftest(textwrap.dedent("""\
+        import pytest
+        from pytest_ansible_playbook import Inventory
+
+        @pytest.fixture(scope='session')
+        def ansible_playbook_inventory():
+            return Inventory(
+                hosts={'localhost': {'ansible_connection': 'local'}},
+                groups={
+                    'web': {'hosts': ['localhost'], 'vars': {'size': 2}},
+                    'site': {'children': ['web']},
+                },
+                vars={'color': 'red', 'size': 1},
+            )
+        """))
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest_ansible_playbook_runner
+
+        def test_foo(ansible_playbook, monkeypatch):
+            monkeypatch.setattr(
+                pytest_ansible_playbook_runner.subprocess, 'Popen', None)
+            inventory = ansible_playbook.get_inventory()
+            assert inventory['_meta']['hostvars']['localhost']['size'] == 2
+            assert ansible_playbook.get_group_hosts('site') == {{'localhost'}}
+            ansible_playbook.run_playbook('{0}')
+        """.format(playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_foo PASSED*',
+        ])
+    with open(test_file_path, 'r') as test_file_object:
+        assert test_file_object.read() == "red 2"
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+
+
+def test_spool(testdir, local_inventory, minimal_playbook):
+    """
+    Make sure that with ``--ansible-playbook-spool`` option, output of
+    ansible-playbook runs is streamed into compressed per test logs, which
+    are kept and attached to the report of failed tests only.
+    """
+    spool_dir = testdir.tmpdir.join("spool")
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        @pytest.mark.ansible_playbook_setup({0})
+        def test_pass(ansible_playbook):
+            pass
+
+        @pytest.mark.ansible_playbook_setup({0})
+        def test_fail(ansible_playbook):
+            assert False
+        """.format({'file': minimal_playbook.basename})))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '--ansible-playbook-spool={0}'.format(spool_dir),
+        '--ansible-playbook-spool-tail=1',
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_pass PASSED*',
+        '*::test_fail FAILED*',
+        '*ansible-playbook output tail (call), full log: *test_fail.log.gz*',
+        '*PLAY RECAP*',
+        ])
+    assert result.ret == 1
+    # only log of the failed test is kept
+    logs = spool_dir.listdir()
+    assert [log.basename for log in logs] == [
+        'test_spool.py_test_fail.log.gz']
+    with gzip.open(str(logs[0]), 'rt') as log_file:
+        log = log_file.read()
+    assert 'Going to run:' in log
+    assert 'PLAY RECAP' in log
+
+
+def test_host_leases(testdir, minimal_playbook):
+    """
+    Make sure that ``ansible_hosts`` marker makes ``ansible_playbook``
+    fixture hold write leases of exclusive and read leases of shared hosts
+    (groups are resolved via inventory) during setup, test and teardown.
+    """
+    inventory = testdir.makefile(
+        ".ini", "[db]", "localhost ansible_connection=local")
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import fcntl
+
+        import pytest
+
+        from pytest_ansible_playbook import get_lease_manager
+
+        def is_locked(request, host, mode):
+            path = get_lease_manager(request.config).get_lock_path(host)
+            with open(path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, mode | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return True
+            return False
+
+        @pytest.mark.ansible_playbook_setup({0})
+        @pytest.mark.ansible_hosts(exclusive=['db'], shared=['other'])
+        def test_leased(request, ansible_playbook):
+            assert is_locked(request, 'localhost', fcntl.LOCK_SH)
+            assert not is_locked(request, 'other', fcntl.LOCK_SH)
+            assert is_locked(request, 'other', fcntl.LOCK_EX)
+            assert ('ansible_hosts_wait', pytest.approx(0, abs=5)) in \\
+                request.node.user_properties
+
+        def test_released(request, ansible_playbook):
+            assert not is_locked(request, 'localhost', fcntl.LOCK_EX)
+            assert not is_locked(request, 'other', fcntl.LOCK_EX)
+        """.format({'file': minimal_playbook.basename})))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(inventory.basename),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_leased PASSED*',
+        '*::test_released PASSED*',
+        '*ansible host leases*',
+        '1 test cases waited *s for host leases in total',
+        ])
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+
+
+def test_record_replay(testdir, local_inventory):
+    """
+    Make sure that playbook runs recorded with ``--ansible-playbook-record``
+    option are returned without running ansible-playbook with
+    ``--ansible-playbook-replay`` option, and that strict replay fails on a
+    run which is not recorded.
+    """
+    test_file_path = testdir.tmpdir.join("replayed.txt")
+    cassette_dir = testdir.tmpdir.join("cassettes")
+    playbook = testdir.makefile(
+        ".yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - copy:",
+        "       content: recorded",
+        "       dest: {0}".format(test_file_path),
+        )
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        @pytest.mark.ansible_playbook_setup({0})
+        def test_foo(ansible_playbook):
+            ret = ansible_playbook.run_playbook('{1}', {{'foo': 'bar'}})
+            assert 'utime' in ret.rusage
+        """.format({'file': playbook.basename}, playbook.basename)))
+    args = [
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '-v',
+        ]
+    result = testdir.runpytest(
+        '--ansible-playbook-record={0}'.format(cassette_dir), *args)
+    assert result.ret == 0
+    assert test_file_path.read() == "recorded"
+    # one cassette for the setup playbook, one for the run in the test
+    assert len(cassette_dir.listdir()) == 2
+
+    test_file_path.remove()
+    result = testdir.runpytest(
+        '--ansible-playbook-replay={0}'.format(cassette_dir),
+        '--ansible-playbook-replay-strict',
+        *args)
+    result.stdout.fnmatch_lines(['*::test_foo PASSED*'])
+    assert result.ret == 0
+    assert not test_file_path.exists()
+
+    # changed playbook is not recorded
+    playbook.write(playbook.read().replace("recorded", "changed"))
+    result = testdir.runpytest(
+        '--ansible-playbook-replay={0}'.format(cassette_dir),
+        '--ansible-playbook-replay-strict',
+        *args)
+    result.stdout.fnmatch_lines([
+        '*::test_foo ERROR*',
+        '*no recorded run of playbook ``{0}``*'.format(playbook.basename),
+        ])
+    assert not test_file_path.exists()
+
+
+def test_slowdown_history(testdir, local_inventory):
+    """
+    Make sure that with ``--ansible-playbook-history`` option, a playbook
+    which is significantly slower than in the previous sessions is reported,
+    and fails the session with ``--ansible-playbook-slowdown-threshold``.
+    """
+    playbook = testdir.makefile(
+        ".yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - action: ping",
+        )
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        @pytest.mark.ansible_playbook_setup({0})
+        def test_foo(ansible_playbook):
+            pass
+        """.format({'file': playbook.basename})))
+    args = [
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '--ansible-playbook-history=5',
+        '--ansible-playbook-slowdown-threshold=2',
+        ]
+    for _ in range(3):
+        result = testdir.runpytest(*args)
+        assert result.ret == 0
+        assert 'slowdowns' not in result.stdout.str()
+
+    playbook.write(playbook.read().rstrip() + "\n   - command: sleep 5\n")
+    result = testdir.runpytest(*args)
+    result.stdout.fnmatch_lines([
+        '*ansible-playbook slowdowns*',
+        'FAILED {0} *s, *x slower than median *s of the last 3 sessions'
+        .format(playbook.basename),
+        '*1 passed*',
+        ])
+    assert result.ret == 1
+
+
+def test_run_duration(testdir, local_inventory, minimal_playbook):
+    """
+    Make sure that wall time of a playbook run doesn't include listing of
+    inventory hosts done on the first run of the instance.
+    """
+    testdir.makeconftest(textwrap.dedent("""\
+        import time
+
+        import pytest
+
+        from pytest_ansible_playbook import PytestAnsiblePlaybook
+
+        @pytest.fixture(autouse=True)
+        def slow_hosts(monkeypatch):
+            get_hosts = PytestAnsiblePlaybook._get_hosts_by_group
+
+            def get_hosts_slowly(*args):
+                time.sleep(3)
+                return get_hosts(*args)
+
+            monkeypatch.setattr(
+                PytestAnsiblePlaybook, '_get_hosts_by_group',
+                get_hosts_slowly)
+        """))
+    testdir.makepyfile(textwrap.dedent("""\
+        from pytest_ansible_playbook import get_run_log
+
+        def test_foo(request, ansible_playbook):
+            ansible_playbook.run_playbook('{0}')
+            ansible_playbook.run_playbook('{0}')
+            durations = [
+                r['duration'] for r in get_run_log(request.config).records]
+            assert len(durations) == 2
+            assert max(durations) - min(durations) < 2
+        """.format(minimal_playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_foo PASSED*',
+        ])
+    assert result.ret == 0
+
+
+def test_concurrent_run_durations(testdir, local_inventory):
+    """
+    Make sure that concurrent ansible-playbook processes of a single
+    instance are returned with their own wall time and resource usage.
+    """
+    playbook = testdir.makefile(
+        ".yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - command: sleep {{ delay }}",
+        )
+    testdir.makepyfile(textwrap.dedent("""\
+        import concurrent.futures
+
+        def test_foo(ansible_playbook):
+            delays = [8, 0, 4]
+            with concurrent.futures.ThreadPoolExecutor(3) as executor:
+                processes = list(executor.map(
+                    lambda delay: ansible_playbook._run_ansible_playbook(
+                        '{0}', {{'delay': delay}}),
+                    delays))
+            assert [p.returncode for p in processes] == [0, 0, 0]
+            assert processes[0].duration > processes[2].duration > \\
+                processes[1].duration
+            assert processes[0].duration >= 8
+            assert all(p.rusage['utime'] > 0 for p in processes)
+        """.format(playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_foo PASSED*',
+        ])
+    assert result.ret == 0
+
+
+@pytest.mark.parametrize("ansible_cfg, expected", [
+    (None, "1 free smart"),
+    ("[defaults]\nforks = 3\nstrategy = linear\n", "3  smart"),
+    ])
+def test_profile(testdir, local_inventory, ansible_cfg, expected):
+    """
+    Make sure that ``--ansible-playbook-profile=fast`` option sets forks
+    based on the inventory and overrides ansible settings via environment,
+    unless they are configured in ansible.cfg.
+    """
+    test_file_path = testdir.tmpdir.join("settings.txt")
+    if ansible_cfg is not None:
+        testdir.tmpdir.join("ansible.cfg").write(ansible_cfg)
+    playbook = testdir.makefile(
+        ".yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - copy:",
+        "       content: \"{{ ansible_forks }} "
+        "{{ lookup('env', 'ANSIBLE_STRATEGY') }} "
+        "{{ lookup('env', 'ANSIBLE_GATHERING') }}\"",
+        "       dest: {0}".format(test_file_path),
+        )
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        def test_foo(ansible_playbook):
+            ansible_playbook.run_playbook('{0}')
+        """.format(playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '--ansible-playbook-profile=fast',
+        '-v',
+        )
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+    assert test_file_path.read() == expected
+
+
+def test_galaxy_requirements(testdir, local_inventory):
+    """
+    Make sure that roles and collections of a requirements file given by
+    ``--ansible-playbook-requirements`` option are installed once into
+    pytest cache and used by playbook runs.
+    """
+    # local role tarball and collection artifact, so that no network is used
+    sources = testdir.mkdir("sources")
+    role = sources.mkdir("myrole")
+    role.mkdir("meta").join("main.yml").write("galaxy_info: {}\n")
+    role.mkdir("tasks").join("main.yml").write(
+        "- copy:\n    content: role\n    dest: '{{ dest }}/role.txt'\n")
+    with tarfile.open(str(sources.join("myrole.tar.gz")), "w:gz") as tar:
+        tar.add(str(sources.join("myrole")), arcname="myrole")
+    for cmd in (['init', 'ns.coll'], ['build', 'ns/coll']):
+        subprocess.run(
+            ['ansible-galaxy', 'collection'] + cmd,
+            cwd=str(sources), check=True, stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if cmd[0] == 'init':
+            sources.join("ns", "coll", "plugins", "filter").ensure(
+                "shout.py").write(textwrap.dedent("""\
+                    class FilterModule(object):
+                        def filters(self):
+                            return {'shout': lambda value: value.upper()}
+                    """))
+    requirements = testdir.makefile(
+        ".requirements.yml",
+        "roles:",
+        "  - src: file://{0}".format(sources.join("myrole.tar.gz")),
+        "    name: myrole",
+        "collections:",
+        "  - name: {0}".format(sources.join("ns-coll-1.0.0.tar.gz")),
+        "    type: file",
+        )
+    playbook = testdir.makefile(
+        ".yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  roles:",
+        "   - role: myrole",
+        "     dest: {0}".format(testdir.tmpdir),
+        "  tasks:",
+        "   - copy:",
+        "       content: \"{{ 'collection' | ns.coll.shout }}\"",
+        "       dest: {0}".format(testdir.tmpdir.join("collection.txt")),
+        )
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        def test_foo(ansible_playbook):
+            ansible_playbook.run_playbook('{0}')
+        """.format(playbook.basename)))
+    args = [
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(local_inventory.basename),
+        '--ansible-playbook-requirements={0}'.format(requirements.basename),
+        ]
+    result = testdir.runpytest(*args)
+    assert result.ret == 0
+    assert testdir.tmpdir.join("role.txt").read() == "role"
+    assert testdir.tmpdir.join("collection.txt").read() == "COLLECTION"
+
+    installed = testdir.tmpdir.join(
+        ".pytest_cache", "d", "ansible_playbook_galaxy").listdir("*.lock")
+    assert len(installed) == 1
+    marker = installed[0].new(ext="").join(".installed")
+    mtime = marker.mtime()
+    # nothing is installed again when the requirements don't change
+    result = testdir.runpytest(*args)
+    assert result.ret == 0
+    assert marker.mtime() == mtime
+
+
+def test_multiple_inventories(testdir, minimal_playbook):
+    """
+    Make sure that when ``--ansible-playbook-matrix-inventory`` option is
+    used more times, test cases using ansible_playbook fixtures or
+    fixture_runner are parametrized by the inventories, with separate
+    session_uuid.
+    """
+    inventories = [
+        testdir.makefile(".{0}.ini".format(name), "{0} {1}".format(
+            host, "ansible_connection=local"))
+        for name, host in (("first", "localhost"), ("second", "127.0.0.1"))]
+    runs_file = testdir.tmpdir.join("runs.txt")
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        from pytest_ansible_playbook import fixture_runner
+
+        def record(pap):
+            with open({0!r}, 'a') as runs_file:
+                runs_file.write('{{0}} {{1}}\\n'.format(
+                    pap.session_uuid,
+                    sorted(pap.get_group_hosts('all'))[0]))
+
+        @pytest.fixture(scope='session')
+        def custom_fixture(request, ansible_playbook_inventory_option):
+            with fixture_runner(request, [{{'file': '{1}'}}]) as pap:
+                yield pap
+
+        def test_foo(ansible_playbook_session, ansible_playbook):
+            assert ansible_playbook_session.session_uuid == \\
+                ansible_playbook.session_uuid
+            record(ansible_playbook)
+
+        def test_bar(custom_fixture):
+            assert custom_fixture.get_group_hosts('all')
+
+        def test_plain():
+            pass
+        """.format(str(runs_file), minimal_playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-matrix-inventory={0}'.format(
+            inventories[0].basename),
+        '--ansible-playbook-matrix-inventory={0}'.format(
+            inventories[1].basename),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines_random([
+        '*::test_foo?test_multiple_inventories.first? PASSED*',
+        '*::test_foo?test_multiple_inventories.second? PASSED*',
+        '*::test_bar?test_multiple_inventories.first? PASSED*',
+        '*::test_bar?test_multiple_inventories.second? PASSED*',
+        '*::test_plain PASSED*',
+        ])
+    assert result.ret == 0
+    runs = [line.split() for line in runs_file.readlines()]
+    assert sorted(host for _, host in runs) == ['127.0.0.1', 'localhost']
+    assert runs[0][0] != runs[1][0]
+
+
+def test_multiple_inventories_prefetch(testdir):
+    """
+    Make sure that with ``--ansible-playbook-prefetch`` option and more
+    ``--ansible-playbook-matrix-inventory`` options, setup playbooks are
+    prefetched only for the next test case of the same inventory, and run
+    with its inventory and session_uuid.
+    """
+    inventories = [
+        testdir.makefile(
+            ".{0}.ini".format(name),
+            "[one]",
+            "{0}1 ansible_connection=local".format(name),
+            "[two]",
+            "{0}2 ansible_connection=local".format(name),
+            )
+        for name in ("first", "second")]
+    playbook = testdir.makefile(
+        ".yml",
+        "---",
+        "- hosts: '{{ group }}'",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - copy:",
+        "       content: '{{ session_uuid }}'",
+        "       dest: '{0}/{{{{ inventory_hostname }}}}.txt'".format(
+            testdir.tmpdir),
+        )
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        def check_setup(pap, group):
+            host, = pap.get_group_hosts(group)
+            with open('{dir}/{{0}}.txt'.format(host)) as host_file:
+                assert host_file.read() == str(pap.session_uuid)
+
+        @pytest.mark.ansible_playbook_setup({{
+            'file': '{playbook}', 'hosts': 'one',
+            'extra_vars': {{'group': 'one'}}}})
+        def test_one(request, ansible_playbook, session_uuid):
+            assert ansible_playbook.session_uuid == session_uuid
+            check_setup(ansible_playbook, 'one')
+            scheduler = request.config._ansible_playbook_prefetch
+            assert list(scheduler._prefetched) == [
+                request.node.nodeid.replace('test_one', 'test_two')]
+
+        @pytest.mark.ansible_playbook_setup({{
+            'file': '{playbook}', 'hosts': 'two',
+            'extra_vars': {{'group': 'two'}}}})
+        def test_two(request, ansible_playbook, session_uuid):
+            assert ansible_playbook.session_uuid == session_uuid
+            check_setup(ansible_playbook, 'two')
+            scheduler = request.config._ansible_playbook_prefetch
+            assert scheduler._prefetched == {{}}
+        """.format(dir=testdir.tmpdir, playbook=playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(playbook.dirname),
+        '--ansible-playbook-matrix-inventory={0}'.format(
+            inventories[0].basename),
+        '--ansible-playbook-matrix-inventory={0}'.format(
+            inventories[1].basename),
+        '--ansible-playbook-prefetch',
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines_random([
+        '*::test_one?*first? PASSED*',
+        '*::test_two?*first? PASSED*',
+        '*::test_one?*second? PASSED*',
+        '*::test_two?*second? PASSED*',
+        ])
+    assert result.ret == 0
+    for host in ('first1', 'first2', 'second1', 'second2'):
+        assert testdir.tmpdir.join(host + '.txt').check()
+
+
+def test_multiple_inventories_deferred_teardown(testdir, minimal_playbook):
+    """
+    Make sure that with more ``--ansible-playbook-matrix-inventory``
+    options, deferred teardown playbooks are run with the inventory and
+    session_uuid of test cases which registered them, and that playbook runs
+    are recorded with their inventory.
+    """
+    inventories = [
+        testdir.makefile(".{0}.ini".format(name), "{0} {1}".format(
+            host, "ansible_connection=local"))
+        for name, host in (("first", "localhost"), ("second", "127.0.0.1"))]
+    teardown = testdir.makefile(
+        ".teardown.yml",
+        "---",
+        "- hosts: all",
+        "  gather_facts: no",
+        "  tasks:",
+        "   - copy:",
+        "       content: '{{ session_uuid }}'",
+        "       dest: '{0}/{{{{ inventory_hostname }}}}.txt'".format(
+            testdir.tmpdir),
+        )
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import os
+
+        import pytest
+
+        from pytest_ansible_playbook import get_run_log
+
+        @pytest.mark.ansible_playbook_setup({{'file': '{setup}'}})
+        @pytest.mark.ansible_playbook_teardown(
+            {{'file': '{teardown}', 'defer': 'module'}})
+        def test_foo(request, ansible_playbook, ansible_playbook_inventory):
+            record = get_run_log(request.config).records[-1]
+            assert record['inventory'] == \\
+                os.path.basename(ansible_playbook_inventory)
+            with open('{dir}/uuids.txt', 'a') as uuids_file:
+                uuids_file.write('{{0}}\\n'.format(
+                    ansible_playbook.session_uuid))
+        """.format(
+            dir=testdir.tmpdir,
+            setup=minimal_playbook.basename,
+            teardown=teardown.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-matrix-inventory={0}'.format(
+            inventories[0].basename),
+        '--ansible-playbook-matrix-inventory={0}'.format(
+            inventories[1].basename),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines_random([
+        '*::test_foo?*first? PASSED*',
+        '*::test_foo?*second? PASSED*',
+        ])
+    assert result.ret == 0
+    uuids = testdir.tmpdir.join('uuids.txt').read().split()
+    assert testdir.tmpdir.join('localhost.txt').read() == uuids[0]
+    assert testdir.tmpdir.join('127.0.0.1.txt').read() == uuids[1]
+
+
+def test_inventory_lanes_without_xdist(testdir, inventory):
+    """
+    Make sure that ``--ansible-playbook-inventory-lanes`` option is refused
+    without pytest-xdist load groups.
+    """
+    result = testdir.runpytest(
+        '--ansible-playbook-inventory={0}'.format(inventory),
+        '--ansible-playbook-inventory-lanes',
+        )
+    result.stderr.fnmatch_lines([
+        'ERROR:*--ansible-playbook-inventory-lanes option requires '
+        'pytest-xdist*',
+        ])
+
+
+def test_matrix_inventory_with_inventory(testdir, inventory):
+    """
+    Make sure that ``--ansible-playbook-matrix-inventory`` option is refused
+    together with ``--ansible-playbook-inventory`` option.
+    """
+    result = testdir.runpytest(
+        '--ansible-playbook-inventory={0}'.format(inventory),
+        '--ansible-playbook-matrix-inventory={0}'.format(inventory),
+        )
+    result.stderr.fnmatch_lines([
+        'ERROR:*--ansible-playbook-matrix-inventory option can\'t be used '
+        'together with --ansible-playbook-inventory option*',
+        ])
+
+
+def test_max_concurrent(testdir, minimal_playbook, inventory):
+    """
+    Make sure that ``--ansible-playbook-max-concurrent`` option queues
+    playbook runs of all threads and reports time spent in the queue.
+    """
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import concurrent.futures
+
+        def test_queue(ansible_playbook):
+            with concurrent.futures.ThreadPoolExecutor(3) as executor:
+                results = list(executor.map(
+                    ansible_playbook.run_playbook, ['{0}'] * 3))
+            assert len(results) == 3
+        """.format(minimal_playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(inventory.basename),
+        '--ansible-playbook-max-concurrent=1',
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_queue PASSED*',
+        '*ansible-playbook run queue*',
+        '3 ansible-playbook runs waited *s for a free slot in total',
+        ])
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+
+
+def test_run_hooks(testdir, minimal_playbook, inventory):
+    """
+    Make sure that playbook run hooks are called for setup, test and
+    teardown runs, and that ``pytest_ansible_playbook_run_override`` hook
+    replaces the run.
+    """
+    testdir.makeconftest(textwrap.dedent("""\
+        RUNS = []
+
+        def pytest_ansible_playbook_run_start(playbook, phase, extra_vars):
+            RUNS.append(('start', playbook, phase))
+
+        def pytest_ansible_playbook_run_override(playbook, extra_vars):
+            if extra_vars.get('cached'):
+                return {'localhost': [{'msg': 'cached'}]}
+
+        def pytest_ansible_playbook_run_finish(
+                playbook, phase, duration, returncode, outputs):
+            RUNS.append(('finish', playbook, phase, duration is None,
+                         returncode, outputs is None))
+        """))
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        from conftest import RUNS
+
+        PLAYBOOK = '{0}'
+
+        @pytest.mark.ansible_playbook_setup({{'file': PLAYBOOK}})
+        @pytest.mark.ansible_playbook_teardown({{'file': PLAYBOOK}})
+        def test_foo(ansible_playbook):
+            ret = ansible_playbook.run_playbook(PLAYBOOK, {{'cached': True}})
+            assert ret['localhost'] == [{{'msg': 'cached'}}]
+
+        def test_runs():
+            assert RUNS == [
+                ('start', PLAYBOOK, 'setup'),
+                ('finish', PLAYBOOK, 'setup', False, 0, False),
+                ('start', PLAYBOOK, 'call'),
+                ('finish', PLAYBOOK, 'call', True, 0, False),
+                ('start', PLAYBOOK, 'teardown'),
+                ('finish', PLAYBOOK, 'teardown', False, 0, False),
+                ]
+        """.format(minimal_playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(inventory.basename),
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_foo PASSED*',
+        '*::test_runs PASSED*',
+        ])
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
+
+
+def test_run_hooks_error(testdir, minimal_playbook, inventory):
+    """
+    Make sure that ``pytest_ansible_playbook_run_finish`` hook is called
+    also when the run raises an exception, without its return code and
+    output.
+    """
+    testdir.makeconftest(textwrap.dedent("""\
+        RUNS = []
+
+        def pytest_ansible_playbook_run_finish(
+                playbook, duration, returncode, outputs):
+            RUNS.append((playbook, duration, returncode, outputs))
+        """))
+    # create a temporary pytest test module
+    testdir.makepyfile(textwrap.dedent("""\
+        import pytest
+
+        from conftest import RUNS
+
+        def test_foo(ansible_playbook):
+            with pytest.raises(Exception, match='no recorded run'):
+                ansible_playbook.run_playbook('{0}')
+            assert RUNS == [('{0}', None, None, None)]
+        """.format(minimal_playbook.basename)))
+    # run pytest with the following cmd args
+    result = testdir.runpytest(
+        '--ansible-playbook-directory={0}'.format(minimal_playbook.dirname),
+        '--ansible-playbook-inventory={0}'.format(inventory.basename),
+        '--ansible-playbook-replay={0}'.format(testdir.tmpdir.mkdir('empty')),
+        '--ansible-playbook-replay-strict',
+        '-v',
+        )
+    # fnmatch_lines does an assertion internally
+    result.stdout.fnmatch_lines([
+        '*::test_foo PASSED*',
+        ])
+    # make sure that that we get a '0' exit code for the testsuite
+    assert result.ret == 0
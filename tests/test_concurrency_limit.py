@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import time
+import threading
+
+from pytest_ansible_playbook import ConcurrencyLimit
+
+
+def run_threads(limit, names, hold=0.1, teardown=()):
+    """
+    Run a thread per name which holds a slot of the limit for ``hold``
+    seconds, return names in order the slots were taken and max number of
+    slots held at once.
+    """
+    order = []
+    active = [0, 0]
+    lock = threading.Lock()
+
+    def run(name):
+        with limit.slot(name in teardown):
+            with lock:
+                order.append(name)
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(hold)
+            with lock:
+                active[0] -= 1
+
+    threads = []
+    for name in names:
+        thread = threading.Thread(target=run, args=(name,))
+        thread.start()
+        threads.append(thread)
+        # make sure that the threads are enqueued in order
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+    return order, active[1]
+
+
+def test_slots_limit(tmp_path):
+    """
+    Make sure that no more than the given number of slots are held at once.
+    """
+    limit = ConcurrencyLimit(2, path=str(tmp_path))
+    order, max_active = run_threads(limit, ['a', 'b', 'c', 'd', 'e'])
+    assert sorted(order) == ['a', 'b', 'c', 'd', 'e']
+    assert max_active == 2
+
+
+def test_fifo_with_teardown_first(tmp_path):
+    """
+    Make sure that waiting runs get the slot in FIFO order, with teardown
+    runs first.
+    """
+    limit = ConcurrencyLimit(1, path=str(tmp_path))
+    order, max_active = run_threads(
+        limit, ['a', 'b', 'c', 'd'], teardown=['d'])
+    assert order == ['a', 'd', 'b', 'c']
+    assert max_active == 1
+
+
+def test_stale_ticket(tmp_path):
+    """
+    Make sure that unlocked ticket of a killed process doesn't block the
+    queue and is removed.
+    """
+    stale = tmp_path.joinpath('0-{0:020d}-1-1.ticket'.format(0))
+    stale.write_text('')
+    limit = ConcurrencyLimit(1, path=str(tmp_path))
+    with limit.slot() as wait:
+        assert wait < 5
+    assert not stale.exists()
+    assert [n for n in os.listdir(str(tmp_path)) if '.ticket' in n] == []
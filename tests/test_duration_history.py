@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+
+import pytest
+
+from pytest_ansible_playbook import DurationHistory
+
+
+class Cache(dict):
+    """
+    Minimal replacement of pytest ``config.cache``.
+    """
+
+    def get(self, key, default):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+
+def get_record(playbook, duration, returncode=0, signature='0' * 16,
+               inventory=None):
+    return {
+        'playbook': playbook,
+        'inventory': inventory,
+        'signature': signature,
+        'duration': duration,
+        'returncode': returncode,
+    }
+
+
+def test_no_slowdown_without_history():
+    """
+    Make sure that at least 3 sessions of history are needed to report a
+    slowdown.
+    """
+    cache = Cache()
+    history = DurationHistory(cache, 5)
+    assert history.update([get_record('a.yml', 1.0)]) == []
+    assert history.update([get_record('a.yml', 1.0)]) == []
+    assert history.update([get_record('a.yml', 10.0)]) == []
+    assert cache[DurationHistory.cache_key]['session'] == 3
+
+
+def test_slowdown():
+    cache = Cache()
+    history = DurationHistory(cache, 5)
+    for duration in (1.0, 1.1, 0.9):
+        assert history.update([get_record('a.yml', duration)]) == []
+    # mean of durations of the session is compared
+    assert history.update([
+        get_record('a.yml', 1.1), get_record('a.yml', 1.3)]) == []
+    slowdowns = history.update([get_record('a.yml', 4.0)])
+    assert len(slowdowns) == 1
+    assert slowdowns[0]['playbook'] == 'a.yml'
+    assert slowdowns[0]['baseline'] == pytest.approx(1.05)
+    assert slowdowns[0]['ratio'] == pytest.approx(4.0 / 1.05)
+    assert slowdowns[0]['sessions'] == 4
+
+
+def test_history_size():
+    """
+    Make sure that history of each key is limited to the last sessions, and
+    that keys not run in the last sessions are dropped.
+    """
+    cache = Cache()
+    history = DurationHistory(cache, 3)
+    history.update([
+        get_record('a.yml', 1.0),
+        get_record('a.yml', 9.0, signature='1' * 16),
+        get_record('b.yml', 2.0),
+        get_record('c.yml', 2.0, returncode=2),
+        get_record('d.yml', None),
+        ])
+    for _ in range(3):
+        history.update([get_record('a.yml', 1.0)])
+    data = cache[DurationHistory.cache_key]
+    assert data['session'] == 4
+    assert data['playbooks'] == {
+        'a.yml:{0}'.format('0' * 16): [4, [1.0, 1.0, 1.0]],
+    }
+
+
+def test_inventories():
+    """
+    Make sure that runs of the same playbook with different inventories are
+    kept apart.
+    """
+    cache = Cache()
+    history = DurationHistory(cache, 5)
+    for _ in range(3):
+        assert history.update([
+            get_record('a.yml', 1.0, inventory='fast.ini'),
+            get_record('a.yml', 4.0, inventory='slow.ini'),
+            ]) == []
+    slowdowns = history.update([
+        get_record('a.yml', 4.0, inventory='fast.ini'),
+        get_record('a.yml', 4.0, inventory='slow.ini'),
+        ])
+    assert [(s['playbook'], s['inventory']) for s in slowdowns] == [
+        ('a.yml', 'fast.ini')]
+    assert sorted(cache[DurationHistory.cache_key]['playbooks']) == [
+        'a.yml:{0}:fast.ini'.format('0' * 16),
+        'a.yml:{0}:slow.ini'.format('0' * 16),
+    ]
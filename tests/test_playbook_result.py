@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+
+import pickle
+
+import pytest
+
+from pytest_ansible_playbook import PlaybookResult
+
+
+@pytest.fixture
+def result():
+    return PlaybookResult({
+        'host1': [
+            {'msg': 'line added', 'changed': True, 'task': 'add line'},
+            {'msg': 'ok', 'changed': False, 'task': 'check', 'role': 'web'},
+        ],
+        'host2': [
+            {'msg': 'boom', 'failed': True, 'task': 'add line'},
+            {'skipped': True, 'task': 'check', 'role': 'web'},
+        ],
+        'host3': [
+            {'msg': 'unreachable', 'unreachable': True, 'task': 'add line'},
+        ],
+    })
+
+
+def test_dict_compatible(result):
+    """
+    Make sure that the result can still be used as a plain dict.
+    """
+    assert result['host1'][0]['msg'] == 'line added'
+    assert sorted(result.keys()) == ['host1', 'host2', 'host3']
+    assert result.by_host('host2') == result['host2']
+    assert result.by_host('missing') == []
+
+
+def test_summary(result):
+    assert result.summary == {
+        'ok': 2,
+        'changed': 1,
+        'failed': 1,
+        'skipped': 1,
+        'unreachable': 1,
+    }
+
+
+def test_lookups(result):
+    assert result.by_status('failed') == [('host2', result['host2'][0])]
+    assert [h for h, _ in result.by_task('add line')] == \
+        ['host1', 'host2', 'host3']
+    assert result.by_task('add line', hosts=['host3']) == \
+        [('host3', result['host3'][0])]
+    assert [h for h, _ in result.by_role('web')] == ['host1', 'host2']
+    assert result.by_task('missing') == []
+    with pytest.raises(ValueError):
+        result.by_status('broken')
+
+
+def test_pickle(result):
+    restored = pickle.loads(pickle.dumps(result))
+    assert restored == result
+    assert restored.summary == result.summary
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import gzip
+import threading
+
+from pytest_ansible_playbook_runner import SpoolFile
+
+
+def test_concurrent_streams(tmp_path):
+    """
+    Make sure that a stream of a test doesn't wait for another stream of the
+    same test, and that output of each stream is kept together in the log.
+    """
+    spool_file = SpoolFile(str(tmp_path.joinpath('test.log.gz')), 1024)
+    slow_read, slow_write = os.pipe()
+    fast_read, fast_write = os.pipe()
+    with open(slow_read, 'rb') as slow_output, \
+            open(fast_read, 'rb') as fast_output:
+        slow = threading.Thread(
+            target=spool_file.stream, args=(slow_output, 'slow\n'),
+            daemon=True)
+        slow.start()
+        os.write(slow_write, b'slow 1\n')
+        os.write(fast_write, b'fast 1\nfast 2\n')
+        os.close(fast_write)
+        fast = threading.Thread(
+            target=spool_file.stream, args=(fast_output, 'fast\n'),
+            daemon=True)
+        fast.start()
+        fast.join(10)
+        # the slow stream is still open
+        assert not fast.is_alive()
+        os.write(slow_write, b'slow 2\n')
+        os.close(slow_write)
+        slow.join(10)
+        assert not slow.is_alive()
+    with gzip.open(spool_file.path, 'rb') as log_file:
+        log = log_file.read()
+    assert log == b'fast\nfast 1\nfast 2\nslow\nslow 1\nslow 2\n'
+    assert spool_file.tail.getvalue() == log
+    assert os.listdir(str(tmp_path)) == ['test.log.gz']